@@ -5,14 +5,17 @@ import asyncio
 import logging.config
 import platform
 import shutil
-import threading
 
 import biliup.common.reload
 from biliup.config import config
-from biliup.downloader import check_url, check_flag
+from biliup.downloader import check_flag
 from . import __version__, LOG_CONF
 from .common.Daemon import Daemon
 from .common.reload import AutoReload
+from .engine.scheduler import CheckScheduler
+from .engine.upload import UploadSweep
+
+logger = logging.getLogger('biliup')
 
 
 def arg_parser():
@@ -52,15 +55,25 @@ def arg_parser():
     args.func()
 
 
+async def log_exception(coro):
+    """后台任务异常退出时立即记录 不必等到 gather 中其他任务结束"""
+    try:
+        return await coro
+    except Exception:
+        logger.exception('后台任务异常退出')
+        raise
+
+
 async def main(args):
     from .handler import event_manager
 
     event_manager.start()
 
-    for plugin in event_manager.context['checker']:
-        # 线程数量是固定的在开始运行的时候创建不会产生变化也不会闲置或者复用线程 所以无需使用线程池
-        # 这里也无需使用异步方法 一个线程一个检测 异步方法让渡控制权没用
-        threading.Thread(target=check_url, args=(event_manager.context['checker'][plugin],)).start()
+    # 所有平台的开播检测由同一个事件循环调度 按平台限制并发与请求速率
+    scheduler = CheckScheduler(event_manager.context, check_flag)
+    event_manager.context['scheduler'] = scheduler
+    # 上传由录制结束触发 定期检查遗留的未上传文件
+    sweep = UploadSweep(event_manager.context)
 
     # 启动时删除临时文件夹
     shutil.rmtree('./cache/temp', ignore_errors=True)
@@ -69,13 +82,15 @@ async def main(args):
     if args.http:
         import biliup.web
         runner, site = await biliup.web.service(args, event_manager)
-        detector = AutoReload(event_manager, runner.cleanup, check_flag.set, interval=interval)
+        detector = AutoReload(event_manager, sweep, runner.cleanup, check_flag.set, interval=interval)
         biliup.common.reload.global_reloader = detector
-        await asyncio.gather(detector.astart(), site.start(), return_exceptions=True)
+        await asyncio.gather(*map(log_exception, (detector.astart(), site.start(), scheduler.run(), sweep.astart())),
+                             return_exceptions=True)
     else:
         # 模块更新自动重启
-        detector = AutoReload(event_manager, check_flag.set, interval=interval)
-        await asyncio.gather(detector.astart(), return_exceptions=True)
+        detector = AutoReload(event_manager, sweep, check_flag.set, interval=interval)
+        await asyncio.gather(*map(log_exception, (detector.astart(), scheduler.run(), sweep.astart())),
+                             return_exceptions=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,340 @@
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger('biliup')
+
+AUDIO = 8
+VIDEO = 9
+SCRIPT = 18
+
+
+class Tag:
+    """FLV tag 只保存类型、时间戳和数据 写出时重新生成tag头"""
+    __slots__ = ('type', 'timestamp', 'body')
+
+    def __init__(self, type_, timestamp, body):
+        self.type = type_
+        self.timestamp = timestamp
+        self.body = body
+
+    @property
+    def is_header(self):
+        """脚本数据(onMetaData)及音视频的编码参数(sequence header)"""
+        if self.type == SCRIPT:
+            return True
+        if len(self.body) < 2:
+            return False
+        if self.type == VIDEO:
+            if self.body[0] & 0x80:
+                # Enhanced FLV: PacketTypeSequenceStart
+                return self.body[0] & 0x0f == 0
+            return self.body[0] & 0x0f in (7, 12) and self.body[1] == 0
+        if self.type == AUDIO:
+            return self.body[0] >> 4 == 10 and self.body[1] == 0
+        return False
+
+    @property
+    def keyframe(self):
+        return (self.type == VIDEO and len(self.body) > 1
+                and (self.body[0] >> 4) & 0x07 == 1 and not self.is_header)
+
+    def digest(self):
+        return hashlib.blake2b(self.body, digest_size=16).digest()
+
+    def write(self, f, timestamp=None):
+        if timestamp is None:
+            timestamp = self.timestamp
+        timestamp &= 0xffffffff
+        size = len(self.body)
+        f.write(bytes((self.type,)) + size.to_bytes(3, 'big') + (timestamp & 0xffffff).to_bytes(3, 'big')
+                + bytes((timestamp >> 24,)) + b'\x00\x00\x00')
+        f.write(self.body)
+        f.write((size + 11).to_bytes(4, 'big'))
+
+
+def read_header(f):
+    """读取文件头和第一个 PreviousTagSize 返回原样的13个字节"""
+    header = f.read(13)
+    if len(header) < 13 or header[:3] != b'FLV':
+        raise ValueError('不是FLV文件')
+    return header
+
+
+def read_tags(f):
+    """依次读取 tag 文件末尾因录制中断而不完整的 tag 会被忽略"""
+    while True:
+        header = f.read(11)
+        if len(header) < 11:
+            return
+        size = int.from_bytes(header[1:4], 'big')
+        body = f.read(size)
+        if len(body) < size:
+            return
+        f.read(4)
+        yield Tag(header[0] & 0x1f, int.from_bytes(header[4:7], 'big') | header[7] << 24, body)
+
+
+def index_keyframes(path):
+    """{关键帧数据的摘要: 时间戳} 以及第一个音视频 tag 的时间戳"""
+    keyframes = {}
+    first = None
+    with open(path, 'rb', buffering=1 << 20) as f:
+        read_header(f)
+        for tag in read_tags(f):
+            if tag.type == SCRIPT or tag.is_header:
+                continue
+            if first is None:
+                first = tag.timestamp
+            if tag.keyframe:
+                keyframes.setdefault(tag.digest(), tag.timestamp)
+    return keyframes, first
+
+
+class _MergeWriter:
+    def __init__(self, f, shift, max_gap):
+        self.f = f
+        self.shift = shift
+        self.max_gap = max_gap
+        # 每种 tag 最近写入的时间戳(主录制的时间轴)
+        self.last = {}
+        self.headers = {}
+        # 每种 tag 从备用录制补充的时长
+        self.filled = {}
+
+    def write(self, tag, timestamp, backup=False):
+        if tag.is_header:
+            if tag.type == SCRIPT:
+                if backup:
+                    return
+            elif self.headers.get(tag.type) == tag.body:
+                # 两份录制的编码参数相同 不必重复写入
+                return
+            else:
+                self.headers[tag.type] = tag.body
+            tag.write(self.f, max(timestamp + self.shift, 0))
+            return
+        last = self.last.get(tag.type)
+        if last is not None and timestamp <= last and (backup or last - timestamp <= self.max_gap):
+            # backup 中已经写入过的部分以及切换录制时重叠的部分，primary 自身时间戳回退较多时仍然写入
+            return
+        if backup:
+            self.filled[tag.type] = self.filled.get(tag.type, 0) + (
+                timestamp - last if last is not None and timestamp > last else 0)
+        self.last[tag.type] = timestamp
+        tag.write(self.f, timestamp + self.shift)
+
+
+def merge(primary, backup, output, max_gap=1000):
+    """
+    以 primary 为主合并同一直播流的两份录制，primary 中超过 max_gap 毫秒的缺口以及缺少的开头、结尾由 backup 填补。
+    两份录制通过相同的关键帧对齐时间戳，只顺序读取两个文件，不会整个读入内存。
+    返回从 backup 补充的毫秒数，两份录制没有相同的关键帧时返回 None 且不写入 output
+    """
+    keyframes, backup_first = index_keyframes(backup)
+    # 同一帧在 backup 与 primary 中的时间戳之差
+    offset = None
+    primary_first = None
+    with open(primary, 'rb', buffering=1 << 20) as f:
+        read_header(f)
+        for tag in read_tags(f):
+            if primary_first is None and tag.type != SCRIPT and not tag.is_header:
+                primary_first = tag.timestamp
+            if tag.keyframe and tag.digest() in keyframes:
+                offset = keyframes[tag.digest()] - tag.timestamp
+                break
+    if offset is None:
+        return None
+
+    with open(primary, 'rb', buffering=1 << 20) as p, open(backup, 'rb', buffering=1 << 20) as b, \
+            open(output, 'wb', buffering=1 << 20) as out:
+        header = bytearray(read_header(p))
+        # 音视频标志取两份录制的并集
+        header[4] |= read_header(b)[4]
+        out.write(header)
+        # backup 比 primary 开始得早时整体后移 避免出现负的时间戳
+        writer = _MergeWriter(out, max(0, offset - (backup_first or 0)), max_gap)
+        primary_tags = read_tags(p)
+        backup_tags = read_tags(b)
+        pt = next(primary_tags, None)
+        bt = next(backup_tags, None)
+        # backup 开始得早时从 backup 开始 这样 primary 缺少的开头也能补上
+        use_backup = backup_first - offset < primary_first
+        synced = None
+        while pt is not None or bt is not None:
+            if pt is not None and pt.is_header:
+                writer.write(pt, pt.timestamp)
+                pt = next(primary_tags, None)
+                continue
+            if pt is not None and pt.keyframe and pt is not synced:
+                # 时间戳可能不连续 每个关键帧重新对齐
+                synced = pt
+                offset = keyframes.get(pt.digest(), pt.timestamp + offset) - pt.timestamp
+            if use_backup:
+                mapped = bt.timestamp - offset if bt is not None else None
+                # 在 primary 的关键帧处切换回 primary，backup 同样缺少数据时也立即切换
+                if bt is None or (pt is not None and mapped >= pt.timestamp
+                                  and (pt.keyframe or mapped - pt.timestamp > max_gap)):
+                    use_backup = False
+                    continue
+                if pt is not None and mapped >= pt.timestamp:
+                    # primary 中已由 backup 写入的部分
+                    pt = next(primary_tags, None)
+                    continue
+                writer.write(bt, mapped, backup=True)
+                bt = next(backup_tags, None)
+            else:
+                if bt is not None and (pt is None or (
+                        pt.timestamp - writer.last.get(pt.type, pt.timestamp) > max_gap
+                        and bt.timestamp - offset < pt.timestamp)):
+                    use_backup = True
+                    continue
+                writer.write(pt, pt.timestamp)
+                pt = next(primary_tags, None)
+    return max(writer.filled.values(), default=0)
+
+
+class FlvParser:
+    """增量解析 HTTP-FLV 数据 每次传入任意长度的数据，返回其中完整的 tag"""
+
+    def __init__(self):
+        # 文件头 解析到之前为None
+        self.header = None
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        pos = 0
+        if self.header is None:
+            if len(buffer) < 9:
+                return []
+            if buffer[:3] != b'FLV':
+                raise ValueError('不是FLV直播流')
+            # DataOffset 之后是第一个 PreviousTagSize
+            pos = int.from_bytes(buffer[5:9], 'big') + 4
+            if len(buffer) < pos:
+                return []
+            # 写入文件时不保留多余的字节
+            self.header = bytes(buffer[:5]) + b'\x00\x00\x00\x09\x00\x00\x00\x00'
+        tags = []
+        while len(buffer) - pos >= 11:
+            if buffer[pos] & 0x1f not in (AUDIO, VIDEO, SCRIPT):
+                # 数据错位后 tag 大小也不可信，继续等待只会不断占用内存
+                if tags:
+                    break
+                raise ValueError('FLV数据损坏')
+            size = int.from_bytes(buffer[pos + 1:pos + 4], 'big')
+            end = pos + 11 + size + 4
+            if len(buffer) < end:
+                break
+            timestamp = int.from_bytes(buffer[pos + 4:pos + 7], 'big') | buffer[pos + 7] << 24
+            tags.append(Tag(buffer[pos] & 0x1f, timestamp, bytes(buffer[pos + 11:end - 4])))
+            pos = end
+        del buffer[:pos]
+        return tags
+
+
+class FlvWriter:
+    """
+    将直播流的 tag 写入分段文件，只在关键帧处(纯音频流为任意音频帧)按 segment_time(秒) 或 file_size(字节) 切分。
+    每个分段重新写入 onMetaData 与编码参数，时间戳从0开始；时间戳回退或跳变超过 max_jump 毫秒时接在上一帧之后。
+    new_name 返回新分段的文件名，写入时使用 .part 后缀，分段结束后去掉；
+    文件名重复时会加上序号，on_open 在分段创建后、on_close 在分段写完更名后以实际使用的文件名调用
+    """
+
+    def __init__(self, new_name, segment_time=None, file_size=None, max_jump=1000, on_open=None, on_close=None):
+        self.new_name = new_name
+        self.on_open = on_open
+        self.on_close = on_close
+        self.segment_time = segment_time
+        self.file_size = file_size
+        self.max_jump = max_jump
+        self.header = None
+        self.has_video = True
+        self.name = None
+        self._file = None
+        self._written = 0
+        # 分段第一帧的时间戳
+        self._base = 0
+        # 最新的 onMetaData 与编码参数 {tag类型: tag}
+        self._headers = {}
+        # 修正时间戳 {tag类型: 偏移}、{tag类型: 上一帧的时间戳}、{tag类型: 帧间隔}
+        self._offset = {}
+        self._last = {}
+        self._interval = {}
+
+    def write_header(self, header):
+        self.header = header
+        self.has_video = bool(header[4] & 0x01)
+
+    def _fix_timestamp(self, tag):
+        timestamp = tag.timestamp + self._offset.get(tag.type, 0)
+        last = self._last.get(tag.type)
+        if last is not None:
+            if timestamp < last or timestamp - last > self.max_jump:
+                fixed = last + self._interval.get(tag.type, 40 if tag.type == VIDEO else 23)
+                self._offset[tag.type] = self._offset.get(tag.type, 0) + fixed - timestamp
+                timestamp = fixed
+            elif timestamp > last:
+                self._interval[tag.type] = timestamp - last
+        self._last[tag.type] = timestamp
+        return timestamp
+
+    def _split(self):
+        if self._file is None:
+            return True
+        if self.segment_time and self._last.get(VIDEO if self.has_video else AUDIO, 0) - self._base \
+                >= self.segment_time * 1000:
+            return True
+        return bool(self.file_size and self._written >= self.file_size)
+
+    def _open(self, base):
+        self.close()
+        name = self.new_name()
+        root, ext = os.path.splitext(name)
+        index = 0
+        # 分段很短时文件名中的时间可能相同
+        while os.path.exists(name) or os.path.exists(f'{name}.part'):
+            index += 1
+            name = f'{root}_{index}{ext}'
+        self.name = name
+        self._file = open(f'{self.name}.part', 'wb')
+        self._file.write(self.header)
+        self._written = len(self.header)
+        self._base = base
+        for tag in self._headers.values():
+            self._write(tag, 0)
+        if self.on_open is not None:
+            self.on_open(self.name)
+
+    def _write(self, tag, timestamp):
+        tag.write(self._file, max(timestamp, 0))
+        self._written += len(tag.body) + 15
+
+    def write(self, tag):
+        if tag.type not in (AUDIO, VIDEO, SCRIPT):
+            return
+        if tag.is_header:
+            self._headers[tag.type] = tag
+            if self._file is not None:
+                self._write(tag, self._last.get(tag.type, self._base) - self._base)
+            return
+        if tag.type == VIDEO:
+            self.has_video = True
+        timestamp = self._fix_timestamp(tag)
+        if (tag.keyframe or (not self.has_video and tag.type == AUDIO)) and self._split():
+            self._open(timestamp)
+        if self._file is not None:
+            # 第一个关键帧之前的数据无法解码
+            self._write(tag, timestamp - self._base)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.replace(f'{self.name}.part', self.name)
+        logger.info(f'更名 {self.name}.part 为 {self.name}')
+        if self.on_close is not None:
+            self.on_close(self.name)
@@ -0,0 +1,175 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """
+    指标的基类 标签值以元组为键保存在字典中，更新时只需加锁修改一个数字，开销足够小可以一直开启
+    """
+    type_ = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} 需要标签 {self.labelnames}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """[(后缀, 标签值, 额外标签, 数值)]"""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_ = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        # 采集时调用 返回 {标签值元组: 数值}，用于队列长度等随时可以读取的状态
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        return [('', tuple(map(str, key)), (), value) for key, value in self.function().items()]
+
+
+class Histogram(Metric):
+    type_ = 'histogram'
+    default_buckets = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        buckets = sorted(buckets or self.default_buckets)
+        if buckets[-1] != math.inf:
+            buckets.append(math.inf)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各区间计数..., 总和]
+                state = self._values[key] = [0] * len(self.buckets) + [0.]
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        result = []
+        for key, state in values:
+            count = 0
+            for bound, n in zip(self.buckets, state):
+                count += n
+                result.append(('_bucket', key, (('le', _format_value(float(bound))),), count))
+            result.append(('_count', key, (), count))
+            result.append(('_sum', key, (), state[-1]))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'指标 {name} 已注册为 {metric.type_}')
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        gauge = self._register(Gauge, name, documentation, labelnames)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def expose(self):
+        """Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Registry()
@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import logging
+import os
+import threading
+import time
+
+from .metrics import metrics
+from .tools import LoopThread
+
+logger = logging.getLogger('biliup')
+
+
+def parse_progress(fields):
+    """将 ffmpeg -progress 输出的一组 key=value 转换为数值"""
+
+    def number(value, suffix='', cast=float):
+        value = value.strip()
+        if value.endswith(suffix):
+            value = value[:len(value) - len(suffix)]
+        try:
+            return cast(value)
+        except ValueError:
+            return None
+
+    stats = {}
+    if 'frame' in fields:
+        stats['frame'] = number(fields['frame'], cast=int)
+    if 'fps' in fields:
+        stats['fps'] = number(fields['fps'])
+    if 'bitrate' in fields:
+        # kbit/s
+        stats['bitrate'] = number(fields['bitrate'], 'kbits/s')
+    if 'total_size' in fields:
+        stats['size'] = number(fields['total_size'], cast=int)
+    if 'speed' in fields:
+        stats['speed'] = number(fields['speed'], 'x')
+    # out_time_ms 实际上也是微秒
+    out_time = fields.get('out_time_us', fields.get('out_time_ms'))
+    if out_time is not None:
+        out_time = number(out_time, cast=int)
+        stats['out_time'] = out_time / 1000000 if out_time is not None else None
+    return stats
+
+
+class SupervisedProcess:
+    """由 ProcessSupervisor 读取输出的子进程"""
+
+    def __init__(self, proc, name, progress=None, log=None, tail=200):
+        self.proc = proc
+        self.name = name
+        # 最近一次 -progress 输出的统计
+        self.stats = {}
+        # 最近的输出 进程异常退出时用于排查
+        self.lines = collections.deque(maxlen=tail)
+        self._progress = progress
+        # 输出大小最近一次增长的时间
+        self.updated = time.monotonic()
+        self._fields = {}
+        self._streams = {stream for stream in (progress, log) if stream is not None}
+        self._closed = threading.Event()
+        if not self._streams:
+            self._closed.set()
+
+    def _feed(self, stream, line):
+        line = line.decode(errors='ignore').rstrip()
+        if stream is not self._progress:
+            self.lines.append(line)
+            return
+        key, _, value = line.partition('=')
+        self._fields[key] = value
+        if key == 'progress':
+            stats = parse_progress(self._fields)
+            if (stats.get('size') or 0) > (self.stats.get('size') or 0):
+                self.updated = time.monotonic()
+            self.stats = stats
+            self._fields = {}
+
+    def _eof(self, stream):
+        self._streams.discard(stream)
+        if not self._streams:
+            self._closed.set()
+
+    def tail(self):
+        return '\n'.join(self.lines)
+
+    def stalled(self, timeout):
+        """输出超过timeout秒没有增长 尚未写入数据时(连接、探测流信息)允许等待更久"""
+        if not self.stats.get('size'):
+            timeout *= 3
+        return time.monotonic() - self.updated > timeout
+
+    def wait(self, timeout=None):
+        """等待输出读取完毕并返回退出码 超时返回None"""
+        if not self._closed.wait(timeout):
+            return None
+        return self.proc.wait()
+
+
+class ProcessSupervisor:
+    """
+    所有录制子进程(ffmpeg、streamlink)的输出由同一个事件循环线程读取，
+    -progress 输出解析为结构化的统计，其他输出只保留最近的若干行，下载线程只需等待进程结束
+    不支持在事件循环中监听管道的平台(Windows)改为每个管道一个读取线程
+    """
+
+    def __init__(self):
+        self._loop_thread = LoopThread('ProcessSupervisor')
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._use_loop = None
+
+    def watch(self, proc, name, progress=None, log=None):
+        """progress为 ffmpeg -progress 的输出管道，log为其他输出的管道"""
+        supervised = SupervisedProcess(proc, name, progress, log)
+        with self._lock:
+            self._processes.add(supervised)
+        for stream in (progress, log):
+            if stream is not None:
+                self._add(supervised, stream)
+        return supervised
+
+    def release(self, supervised):
+        with self._lock:
+            self._processes.discard(supervised)
+
+    def running(self):
+        with self._lock:
+            return list(self._processes)
+
+    def _add(self, supervised, stream):
+        if self._use_loop is None:
+            self._use_loop = isinstance(self._loop_thread.loop, asyncio.SelectorEventLoop)
+        if self._use_loop:
+            self._loop_thread.call_soon(self._add_reader, supervised, stream)
+        else:
+            threading.Thread(target=self._read_lines, args=(supervised, stream),
+                             name=f'{supervised.name}-output', daemon=True).start()
+
+    def _add_reader(self, supervised, stream):
+        os.set_blocking(stream.fileno(), False)
+        buffer = bytearray()
+
+        def on_readable():
+            try:
+                data = os.read(stream.fileno(), 64 * 1024)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                if buffer:
+                    supervised._feed(stream, bytes(buffer))
+                self._loop_thread.loop.remove_reader(stream.fileno())
+                stream.close()
+                supervised._eof(stream)
+                return
+            buffer.extend(data)
+            *lines, rest = buffer.split(b'\n')
+            buffer[:] = rest
+            for line in lines:
+                supervised._feed(stream, line)
+
+        self._loop_thread.loop.add_reader(stream.fileno(), on_readable)
+
+    @staticmethod
+    def _read_lines(supervised, stream):
+        try:
+            with stream:
+                for line in iter(stream.readline, b''):
+                    supervised._feed(stream, line)
+        finally:
+            supervised._eof(stream)
+
+
+supervisor = ProcessSupervisor()
+
+
+def _running_stats(key):
+    return {(p.name,): p.stats[key] for p in supervisor.running() if p.stats.get(key) is not None}
+
+
+metrics.gauge('biliup_ffmpeg_bitrate', '正在录制的 ffmpeg 输出码率(kbit/s)', ('name',),
+              function=lambda: _running_stats('bitrate'))
+metrics.gauge('biliup_ffmpeg_speed', '正在录制的 ffmpeg 处理速度(倍速)', ('name',),
+              function=lambda: _running_stats('speed'))
+metrics.gauge('biliup_ffmpeg_size', '正在录制的 ffmpeg 已写入字节数', ('name',),
+              function=lambda: _running_stats('size'))
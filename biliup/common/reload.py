@@ -1,5 +1,8 @@
 import asyncio
+import ctypes
+import ctypes.util
 import logging
+import struct
 import subprocess
 import sys
 import os
@@ -10,12 +13,58 @@ logger = logging.getLogger('biliup')
 global global_reloader
 
 
-def has_extension(fname_list, *extension):
-    for fname in fname_list:
-        result = list(map(fname.endswith, extension))
-        if True in result:
-            return True
-    return False
+class InotifyWatcher:
+    """
+    基于 inotify 的文件变化监听 只在 Linux 下可用
+    监听文件所在的目录 以便捕获编辑器先写临时文件再重命名的保存方式
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+    _event = struct.Struct('iIII')
+
+    def __init__(self, dirs, filter_func):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self.filter_func = filter_func
+        self._dirs = {}
+        mask = self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for directory in dirs:
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch {directory}')
+            self._dirs[wd] = directory
+
+    def read(self):
+        """返回自上次读取以来发生变化且通过 filter_func 的文件"""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self._event.unpack_from(data, offset)
+                offset += self._event.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                path = os.path.join(self._dirs.get(wd, ''), name)
+                if self.filter_func(path):
+                    changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
 
 
 class AutoReload(Timer):
@@ -24,23 +73,68 @@ class AutoReload(Timer):
         self.watched = watched
         self.mtimes = {}
         self.triggered = False
+        self.changed = False
+        self.config_changed = False
+        self._watcher = None
 
     @staticmethod
-    def _iter_module_files():
-        """Iterator to module's source filename of sys.modules (built-in
-        excluded).
-        """
+    def _package_dir():
+        return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    @staticmethod
+    def _config_file():
+        from biliup.config import config
+        return config.path
+
+    def _is_watched(self, filename):
+        if filename == self._config_file():
+            return True
+        return filename.endswith('.py') and filename.startswith(self._package_dir() + os.sep)
+
+    def _iter_module_files(self):
+        """Iterator to source filename of biliup's own modules and the config file."""
         for module in list(sys.modules.values()):
             filename = getattr(module, '__file__', None)
             if filename:
                 if filename[-4:] in ('.pyo', '.pyc'):
                     filename = filename[:-1]
-                yield filename
+                if self._is_watched(os.path.abspath(filename)):
+                    yield filename
+        if self._config_file():
+            yield self._config_file()
+
+    def _watch(self):
+        """优先使用 inotify 监听 不可用时退回定时检查修改时间"""
+        dirs = [root for root, _, _ in os.walk(self._package_dir()) if '__pycache__' not in root]
+        if self._config_file():
+            dirs.append(os.path.dirname(self._config_file()))
+        try:
+            self._watcher = InotifyWatcher(dict.fromkeys(dirs), self._is_watched)
+            asyncio.get_running_loop().add_reader(self._watcher.fd, self._on_inotify)
+            logger.debug(f'inotify 监听 {len(dirs)} 个目录')
+        except (OSError, AttributeError, NotImplementedError) as e:
+            logger.debug(f'inotify 不可用，改为定时检查文件修改时间: {e}')
+            if self._watcher is not None:
+                self._watcher.close()
+            self._watcher = False
+
+    def _on_inotify(self):
+        changed = self._watcher.read()
+        if self._config_file() in changed:
+            changed.discard(self._config_file())
+            self.config_changed = True
+        if changed:
+            logger.info(f'模块已更新 {", ".join(changed)}')
+            self.changed = True
 
     def _is_any_file_changed(self):
-        """Return 1 if there is any source file of sys.modules changed,
+        """Return 1 if there is any source file of biliup changed,
         otherwise 0. mtimes is dict to store the last modify time for
-        comparing."""
+        comparing. Changes of the config file only set config_changed."""
+        if self._watcher is None:
+            self._watch()
+        if self._watcher:
+            return self.changed
         for filename in self._iter_module_files():
             try:
                 mtime = os.stat(filename).st_mtime
@@ -50,14 +144,42 @@ class AutoReload(Timer):
             if old_time is None:
                 self.mtimes[filename] = mtime
             elif mtime > old_time:
+                if filename == self._config_file():
+                    self.mtimes[filename] = mtime
+                    self.config_changed = True
+                    continue
                 logger.info('模块已更新')
                 return True
         return False
 
+    def _reload_config(self):
+        """配置文件修改后直接应用到运行中的进程 不需要重启"""
+        self.config_changed = False
+        from biliup.config import config
+        from biliup.handler import reload_streamers
+        try:
+            if os.stat(config.path).st_mtime == config.saved_mtime:
+                # 网页保存配置时已经重新加载
+                return
+        except OSError:
+            pass
+        try:
+            config.reload()
+        except Exception:
+            # 保存到一半或格式错误时继续使用原来的配置
+            logger.exception('配置文件加载失败')
+            return
+        logger.info('配置文件已更新')
+        reload_streamers()
+
     @staticmethod
     def _work_free():
-        fname_list = os.listdir('.')
-        if has_extension(fname_list, '.mp4', '.flv', '.3gp', '.webm', '.mkv', '.ts', '.part'):
+        from biliup.handler import event_manager
+        context = event_manager.context
+        # 正在录制或上传时不重启
+        if any(status == 1 for status in context['url_status'].values()):
+            return False
+        if any(count > 0 for count in context['url_upload_count'].values()):
             return False
         logger.info('进程空闲')
         return True
@@ -66,7 +188,10 @@ class AutoReload(Timer):
         """Check file state ervry interval. If any change is detected, exit this
         process with a special code, so that deamon will to restart a new process.
         """
-        if not self._is_any_file_changed() and not self.triggered:
+        changed = self._is_any_file_changed()
+        if self.config_changed:
+            self._reload_config()
+        if not changed and not self.triggered:
             return
         while True:
             await asyncio.sleep(self.interval)
@@ -1,4 +1,7 @@
+import asyncio
+import concurrent.futures
 import threading
+import time
 from _thread import LockType
 
 
@@ -10,3 +13,80 @@ class NamedLock:
         if name not in cls._lock_dict:
             cls._lock_dict[name] = threading.Lock()
         return cls._lock_dict[name]
+
+
+# 线程安全的令牌桶 rate为每秒补充的令牌数 rate<=0时不限速
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        """预定n个令牌，返回需要等待的秒数。令牌不足时允许透支，由等待时间偿还"""
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self, n=1):
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, n=1):
+        wait = self.reserve(n)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+# 指数退避 连续失败时等待时间翻倍 成功后调用reset
+class Backoff:
+    def __init__(self, initial=1., maximum=10., factor=2.):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self._next = initial
+
+    def next(self):
+        delay = self._next
+        self._next = min(self._next * self.factor, self.maximum)
+        return delay
+
+    def reset(self):
+        self._next = self.initial
+
+
+# 运行在后台守护线程中的事件循环 供阻塞的线程提交协程 首次使用时才会创建线程
+class LoopThread:
+    def __init__(self, name):
+        self.name = name
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run, args=(self._loop,), name=self.name, daemon=True).start()
+        return self._loop
+
+    @staticmethod
+    def _run(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
@@ -1,4 +1,5 @@
 import json
+import os
 import pathlib
 import shutil
 from collections import UserDict
@@ -10,6 +11,13 @@ except ModuleNotFoundError:
 
 
 class Config(UserDict):
+    # 加载的配置文件路径
+    path = None
+    # 配置文件中的项
+    file_keys = set()
+    # 最近一次由 save 写入后配置文件的修改时间 监听到这次修改时不必重新加载
+    saved_mtime = None
+
     def load_cookies(self):
         self.data["user"] = {"cookies": {}}
         with open('cookies.json', encoding='utf-8') as stream:
@@ -29,11 +37,13 @@ class Config(UserDict):
                 file = open('config.toml', "rb")
             else:
                 raise FileNotFoundError('未找到配置文件，请先创建配置文件')
+        self.path = os.path.abspath(file.name)
         with file as stream:
             if file.name.endswith('.toml'):
                 self.data = tomllib.load(stream)
             else:
                 self.data = yaml.load(stream, Loader=yaml.FullLoader)
+            self.file_keys = set(self.data)
 
     def create_without_config_input(self, file):
         import yaml
@@ -59,12 +69,34 @@ class Config(UserDict):
             #     shutil.copy(files("biliup.web").joinpath('public/config.yaml'), 'common')
             #     file = open('config.yaml', encoding='utf-8')
 
+        self.path = os.path.abspath(file.name)
         with file as stream:
             if file.name.endswith('.toml'):
                 self.data = tomllib.load(stream)
+                self.file_keys = set(self.data)
                 self.data['toml'] = True
             else:
                 self.data = yaml.load(stream, Loader=yaml.FullLoader)
+                self.file_keys = set(self.data)
+
+    def reload(self):
+        """
+        重新读取配置文件，只替换配置文件中的项，
+        运行时写入的内容(如 event_manager.context 中的状态)保持不变
+        """
+        with open(self.path, 'rb') as stream:
+            if self.path.endswith('.toml'):
+                data = tomllib.load(stream)
+            else:
+                import yaml
+                data = yaml.load(stream, Loader=yaml.FullLoader)
+        for key in self.file_keys - set(data):
+            self.data.pop(key, None)
+        if 'user' in self.data and 'user' not in data:
+            # toml 配置的 user 来自 cookies.json
+            self.file_keys.discard('user')
+        self.data.update(data)
+        self.file_keys |= set(data)
 
     def save(self):
         if self.data.get('toml'):
@@ -76,6 +108,7 @@ class Config(UserDict):
                 old_data["streamers"] = self.data["streamers"]
             with open('config.toml', 'wb') as stream:
                 tomli_w.dump(old_data, stream)
+            self.saved_mtime = os.stat('config.toml').st_mtime
         else:
             import yaml
             with open('config.yaml', 'w+', encoding='utf-8') as stream:
@@ -86,6 +119,7 @@ class Config(UserDict):
                 old_data["threads"] = self.data["threads"]
                 old_data["streamers"] = self.data["streamers"]
                 yaml.dump(old_data, stream, default_flow_style=False, allow_unicode=True)
+            self.saved_mtime = os.stat('config.yaml').st_mtime
 
 
 config = Config()
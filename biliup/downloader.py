@@ -1,110 +1,73 @@
 import logging
-import re
 import threading
-import time
-from urllib.error import HTTPError
 
 from .common.tools import NamedLock
 from .engine.decorators import Plugin
 
-from .engine.download import DownloadBase
 from .engine.event import Event
-from .plugins import general
-from biliup.config import config
 
 logger = logging.getLogger('biliup')
 check_flag = threading.Event()
 
 def download(fname, url, **kwargs):
-    pg = general.__plugin__(fname, url)
-    for plugin in Plugin.download_plugins:
-        if re.match(plugin.VALID_URL_BASE, url):
-            pg = plugin(fname, url)
-            for k in pg.__dict__:
-                if kwargs.get(k):
-                    pg.__dict__[k] = kwargs.get(k)
-            break
+    plugin = Plugin.get_download_plugin(url)
+    if plugin is None:
+        from .plugins import general
+        pg = general.__plugin__(fname, url)
+    else:
+        pg = plugin(fname, url)
+        for k in pg.__dict__:
+            if kwargs.get(k):
+                pg.__dict__[k] = kwargs.get(k)
     return pg.start()
 
 
-def check_url(checker):
-    from .handler import event_manager
-    # 单主播检测延迟
-    checker_sleep = config.get('checker_sleep', 10)
-    # 平台检测延迟
-    event_loop_interval = config.get('event_loop_interval', 30)
-    context = event_manager.context
-    class_reference = type(checker('', ''))
-
-    while not check_flag.is_set():
-        try:
-            # 待检测url
-            check_urls = []
-            # 过滤url
-            for url in checker.url_list:
-                # 同一主播多个url
-                # 多个url只能同时下载一个
-                is_download = False
-                streamer_urls = context['streamers'][context['inverted_index'][url]]['url']
-                for streamer_url in streamer_urls:
-                    if context['url_status'][streamer_url] == 1:
-                        logger.debug(f'{url}-{streamer_url}-正在下载中，跳过检测')
-                        is_download = True
-                        break
-                if is_download:
-                    continue
-
-                send_upload_event({'name': context['inverted_index'][url], 'url': url})
-                check_urls.append(url)
-
-            if DownloadBase.batch_check != getattr(class_reference, DownloadBase.batch_check.__name__):
-                # 如果支持批量检测
-                # 发送下载的事件
-                for url in class_reference.batch_check(check_urls):
-                    send_download_event(context['inverted_index'][url], url)
-            else:
-                # 不支持批量检测
-                for (index, url) in enumerate(check_urls):
-                    # 某个检测异常略过不应影响其他检测
-                    try:
-                        if index > 0:
-                            logger.debug('歇息会')
-                            time.sleep(checker_sleep)
-
-                        if checker(context['inverted_index'][url], url).check_stream(True):
-                            send_download_event(context['inverted_index'][url], url)
-                    except HTTPError as e:
-                        logger.error(f'{checker.__module__} {e.url} => {e}')
-                    except IOError:
-                        logger.exception("IOError")
-                    except:
-                        logger.exception("Uncaught exception:")
-
-        except:
-            # 除了单个检测异常 其他异常会影响整体 直接略过本次 等待下次整体检测
-            logger.exception("Uncaught exception:")
-
-        time.sleep(event_loop_interval)
-
-
 def send_download_event(name, url):
     # 永远不可能对同一个url同时发送两次下载事件
     from .handler import event_manager, DOWNLOAD
     content = event_manager.context
     # 需要等待上传文件列表检索完成后才可以开始下次下载
     with NamedLock(f'upload_file_list_{name}'):
+        if name not in content['streamers'] or url not in content['streamers'][name]['url']:
+            # 检测期间主播已被移出配置
+            return False
         for streamer_url in content['streamers'][content['inverted_index'][url]]['url']:
             if content['url_status'][streamer_url] == 1:
                 return False
         content['url_status'][url] = 1
-        event_manager.send_event(Event(DOWNLOAD, args=(name, url,)))
+    # 队列已满时 send_event 会阻塞，不能持有锁
+    event_manager.send_event(Event(DOWNLOAD, args=(name, url,), key=url))
     return True
 
 
-def send_upload_event(stream_info):
-    # 可能对同一个url同时发送两次上传事件
-    with NamedLock(f"upload_count_{stream_info['url']}"):
-        from .handler import event_manager, UPLOAD
-        # += 不是原子操作
-        event_manager.context['url_upload_count'][stream_info['url']] += 1
-        event_manager.send_event(Event(UPLOAD, (stream_info,)))
+def _send_counted(url, event):
+    """
+    发送上传类事件并计入 url_upload_count，事件处理结束时减一。
+    先在锁内计数再发送：队列已满时 send_event 会阻塞，持有锁会与处理结束时的减一互相等待
+    """
+    from .handler import event_manager
+    url_upload_count = event_manager.context['url_upload_count']
+    with NamedLock(f"upload_count_{url}"):
+        url_upload_count[url] += 1
+    if event_manager.send_event(event):
+        return True
+    # 已合并到等待中的事件
+    with NamedLock(f"upload_count_{url}"):
+        url_upload_count[url] -= 1
+    return False
+
+
+def send_segment_event(stream_info, filename):
+    """分段录制完成 预先上传该分段"""
+    from .handler import SEGMENT
+    return _send_counted(stream_info['url'], Event(SEGMENT, (stream_info, filename), key=filename))
+
+
+def send_upload_event(stream_info, coalesce=False):
+    """
+    coalesce为True时 同一主播已有等待中的上传事件则不再发送，
+    用于只需要上传遗留文件的场合；下载结束后携带录制信息的上传事件总是发送
+    """
+    from .handler import UPLOAD
+    key = stream_info['name'] if coalesce else None
+    return _send_counted(stream_info['url'], Event(UPLOAD, (stream_info,), key=key))
@@ -0,0 +1,184 @@
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from biliup.config import config
+from .layout import iter_output_files, output_volumes
+
+logger = logging.getLogger('biliup')
+
+media_extensions = ['.mp4', '.flv', '.3gp', '.webm', '.mkv', '.ts']
+
+
+class RecordingCatalog:
+    """
+    录播文件索引 {主播: {文件名: 创建时间}}
+    由下载端在创建和更名分段时写入，持久化到 cache/catalog.json 以便重启后继续上传，
+    上传时只需查询对应主播的文件，不再扫描整个工作目录。
+    修改后延迟 save_delay 秒写入，合并同一时间多个分段产生的修改，退出时写入尚未保存的修改。
+    """
+    save_delay = 2
+
+    def __init__(self, path='cache/catalog.json'):
+        self.path = path
+        self._lock = threading.RLock()
+        # 同一时间只有一个线程写入文件
+        self._write_lock = threading.Lock()
+        self._files = None
+        self._dirty = False
+        self._timer = None
+
+    @staticmethod
+    def _strip(filename):
+        filename = os.path.normpath(filename)
+        if filename.endswith('.part'):
+            return filename[:-len('.part')]
+        return filename
+
+    @staticmethod
+    def _exists(filename):
+        return os.path.isfile(filename) or os.path.isfile(filename + '.part')
+
+    def _index(self):
+        # 调用时需持有 _lock
+        if self._files is None:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self._files = json.load(f)
+            except FileNotFoundError:
+                self._files = {}
+                self._discover()
+            except (ValueError, OSError):
+                logger.exception(f'读取录播索引失败 {self.path}')
+                self._files = {}
+                self._discover()
+        return self._files
+
+    def _discover(self, only=None):
+        """
+        扫描录播目录中未被索引的文件 文件归属于名字包含在文件名(或路径)中的最长的主播
+        没有索引文件时在启动时扫描一次，only 不为空时只收录该主播的文件
+        """
+        streamers = sorted(config.get('streamers', {}), key=len, reverse=True)
+        entries = list(iter_output_files())
+        if '.' not in map(os.path.normpath, output_volumes()):
+            # 设置 output_root 之前保存在工作目录的录播
+            entries += list(os.scandir('.'))
+        owned = {name for files in self._files.values() for name in files}
+        changed = False
+        for entry in entries:
+            name = self._strip(entry.path)
+            if (name in owned or not entry.is_file()
+                    or os.path.splitext(name)[1] not in (*media_extensions, '.xml')):
+                continue
+            # 优先按文件名匹配 文件名中没有主播名时再按所在目录匹配
+            streamer = (next((s for s in streamers if s in os.path.basename(name)), None)
+                        or next((s for s in streamers if s in name), None))
+            if streamer is not None and (only is None or streamer == only):
+                self._files.setdefault(streamer, {})[name] = entry.stat().st_ctime
+                changed = True
+        if changed:
+            self._save()
+
+    def rescan(self, streamer):
+        """外部程序(如 downloaded_processor)修改或生成了录播文件后重新收录"""
+        with self._lock:
+            self._index()
+            self._discover(streamer)
+
+    def _save(self):
+        # 调用时需持有 _lock
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.save_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """立即写入尚未保存的修改"""
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                data = json.dumps(self._files, ensure_ascii=False)
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = f'{self.path}.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except OSError:
+                logger.exception(f'保存录播索引失败 {self.path}')
+
+    def add(self, streamer, filename, created=None):
+        filename = self._strip(filename)
+        with self._lock:
+            files = self._index().setdefault(streamer, {})
+            if filename in files:
+                return
+            files[filename] = time.time() if created is None else created
+            self._save()
+
+    @staticmethod
+    def _wildcard(part):
+        if not part.startswith('%'):
+            return re.escape(part)
+        # 数字类的时间格式只匹配数字 避免主播A匹配到主播AB的文件
+        if part[-1] in 'YmdHMSjyIUWwfGuV':
+            return r'\d+'
+        return '.+?'
+
+    def scan(self, streamer, template, directory='.'):
+        """
+        按文件名模板在 directory 中查找下载器自行命名的分段，如stream_gears按时间分段、yt-dlp决定扩展名
+        template 为未格式化的文件名，其中的时间格式化符号视为通配
+        """
+        pattern = re.compile(''.join(map(self._wildcard, re.split(r'(%-?\w)', template))) + r'.*')
+        found = {}
+        for entry in os.scandir(directory):
+            name = self._strip(entry.name)
+            if (entry.is_file() and os.path.splitext(name)[1] in (*media_extensions, '.xml')
+                    and pattern.fullmatch(name)):
+                found[self._strip(entry.path)] = entry.stat().st_ctime
+        with self._lock:
+            index = self._index()
+            owned = {name for files in index.values() for name in files}
+            files = index.setdefault(streamer, {})
+            new = {name: created for name, created in found.items() if name not in owned}
+            if new:
+                files.update(new)
+                self._save()
+
+    def discard(self, filename):
+        filename = self._strip(filename)
+        with self._lock:
+            for files in self._index().values():
+                if files.pop(filename, None) is not None:
+                    self._save()
+                    return
+
+    def files(self, streamer):
+        """主播的录播文件(包括未完成的.part)，按创建时间排序，已不存在的文件会移出索引"""
+        with self._lock:
+            files = self._index().get(streamer, {})
+            missing = [name for name in files if not self._exists(name)]
+            for name in missing:
+                del files[name]
+            if missing:
+                self._save()
+            result = []
+            for name in sorted(files, key=files.get):
+                result.append(name if os.path.isfile(name) else name + '.part')
+            return result
+
+
+catalog = RecordingCatalog()
+atexit.register(catalog.flush)
@@ -2,23 +2,52 @@ import functools
 import importlib
 import pkgutil
 import re
+from urllib.parse import urlparse
 
 
-def suit_url(pattern, urls):
-    sorted_url = []
-    for i in range(len(urls) - 1, -1, -1):
-        if re.match(pattern, urls[i]):
-            sorted_url.append(urls[i])
-            urls.remove(urls[i])
-    return sorted_url
+class UrlRouter:
+    """
+    预编译的url路由 按顺序返回第一个匹配的正则对应的目标
+    同一url重复查询时直接使用缓存的结果
+    """
+    max_cache = 4096
+
+    def __init__(self, routes):
+        self.routes = [(re.compile(pattern), target) for pattern, target in routes]
+        self._cache = {}
+
+    def match(self, url):
+        """返回 (目标, re.Match)，没有匹配时返回 (None, None)"""
+        result = self._cache.get(url)
+        if result is None:
+            result = None, None
+            for regex, target in self.routes:
+                match = regex.match(url)
+                if match:
+                    result = target, match
+                    break
+            if len(self._cache) >= self.max_cache:
+                self._cache.clear()
+            self._cache[url] = result
+        return result
+
+    @staticmethod
+    def room_id(url, match):
+        """正则中有 id 或 username 分组时取分组 否则取url路径的最后一段"""
+        if match is not None:
+            groups = match.groupdict()
+            for key in ('id', 'username'):
+                if groups.get(key):
+                    return groups[key]
+        path = urlparse(url if '://' in url else f'http://{url}').path
+        return path.rstrip('/').rsplit('/', 1)[-1] or None
 
 
 class Plugin:
     download_plugins = []
     upload_plugins = {}
-
-    def __init__(self, pkg):
-        self.load_plugins(pkg)
+    _unlisted = None
+    _router = None
 
     @staticmethod
     def download(regexp):
@@ -38,39 +67,86 @@ class Plugin:
             return cls
         return decorator
 
+    @staticmethod
+    def _import(name):
+        return importlib.import_module(f'biliup.plugins.{name}')
+
+    @classmethod
+    def _unlisted_plugins(cls):
+        """未在插件清单中登记的下载插件(如用户自行添加的插件)，首次调用时导入"""
+        if cls._unlisted is None:
+            from .. import plugins
+            listed = {*plugins.download_manifest, *plugins.upload_manifest.values(), 'general', 'Danmaku'}
+            for _, name, _ in pkgutil.iter_modules(plugins.__path__):
+                if name not in listed:
+                    cls._import(name)
+            cls._unlisted = [plugin for plugin in cls.download_plugins
+                             if plugin.__module__.rsplit('.', 1)[-1] not in plugins.download_manifest]
+        return cls._unlisted
+
+    @classmethod
+    def router(cls):
+        """
+        下载插件的url路由 目标为 (模块名, url正则)，未登记的插件模块名为None
+        插件清单中的模块在第一次路由到时才导入
+        """
+        if cls._router is None:
+            from .. import plugins
+            routes = [(pattern, (name, pattern))
+                      for name, patterns in plugins.download_manifest.items() for pattern in patterns]
+            routes += [(plugin.VALID_URL_BASE, (None, plugin.VALID_URL_BASE)) for plugin in cls._unlisted_plugins()]
+            cls._router = UrlRouter(routes)
+        return cls._router
+
+    @classmethod
+    def _download_plugin(cls, name, pattern):
+        if name is not None:
+            # 未登记的插件已经导入
+            cls._import(name)
+        for plugin in cls.download_plugins:
+            if plugin.VALID_URL_BASE == pattern:
+                return plugin
+        raise LookupError(f'插件清单与 biliup.plugins.{name} 不一致: {pattern}')
+
+    @classmethod
+    def route(cls, url):
+        """返回 (下载插件, 房间号)，没有匹配的插件时插件为None"""
+        target, match = cls.router().match(url)
+        plugin = None if target is None else cls._download_plugin(*target)
+        return plugin, UrlRouter.room_id(url, match)
+
+    @classmethod
+    def get_download_plugin(cls, url):
+        """url对应的下载插件 没有匹配的插件时返回None"""
+        return cls.route(url)[0]
+
+    @classmethod
+    def get_upload_plugin(cls, platform):
+        from .. import plugins
+        if platform not in cls.upload_plugins:
+            name = plugins.upload_manifest.get(platform)
+            if name is not None:
+                cls._import(name)
+            else:
+                cls._unlisted_plugins()
+        return cls.upload_plugins.get(platform)
+
     @classmethod
     def sorted_checker(cls, urls):
-        from ..plugins import general
-        curls = urls.copy()
         checker_plugins = {}
-        for plugin in cls.download_plugins:
-            url_list = suit_url(plugin.VALID_URL_BASE, curls)
-            if not url_list:
-                continue
+        url_lists = {}
+        rest = []
+        for url in urls:
+            plugin = cls.get_download_plugin(url)
+            if plugin is None:
+                rest.append(url)
             else:
-                plugin.url_list = url_list
-                checker_plugins[plugin.__name__] = plugin
-            if not curls:
-                return checker_plugins
-        general.__plugin__.url_list = curls
-        checker_plugins[general.__plugin__.__name__] = general.__plugin__
+                url_lists.setdefault(plugin, []).append(url)
+        for plugin, url_list in url_lists.items():
+            plugin.url_list = url_list
+            checker_plugins[plugin.__name__] = plugin
+        if rest:
+            from ..plugins import general
+            general.__plugin__.url_list = rest
+            checker_plugins[general.__plugin__.__name__] = general.__plugin__
         return checker_plugins
-
-    def load_plugins(self, pkg):
-        """Attempt to load plugins from the path specified.
-        engine.plugins.__path__[0]: full path to a directory where to look for plugins
-        """
-
-        plugins = []
-
-        for loader, name, ispkg in pkgutil.iter_modules([pkg.__path__[0]]):
-            # set the full plugin module name
-            module_name = f"{pkg.__name__}.{name}"
-            module = importlib.import_module(module_name)
-            if ispkg:
-                self.load_plugins(module)
-                continue
-            if module in plugins:
-                continue
-            plugins.append(module)
-        return plugins
@@ -1,20 +1,36 @@
+import asyncio
+import contextlib
 import logging
 import os
 import re
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator, List
 from urllib.parse import urlparse
 
+import aiohttp
 import requests
 import stream_gears
-from PIL import Image
 
 from biliup.config import config
+from ..common import flv
+from ..common.metrics import metrics
+from ..common.process import supervisor
+from ..common.tools import Backoff
+from . import httpflv
+from .catalog import catalog, media_extensions
+from .layout import output_dir, placement
 
 logger = logging.getLogger('biliup')
 
+recorded_bytes = metrics.counter('biliup_recorded_bytes_total', '录制写入的字节数', ('streamer', 'plugin'))
+recording_seconds = metrics.histogram('biliup_recording_seconds', '每次录制的时长', ('plugin',),
+                                      buckets=(60, 300, 900, 1800, 3600, 7200, 14400))
+recording_bitrate = metrics.gauge('biliup_recording_bitrate', '最近一次录制的平均码率(bit/s)', ('streamer',))
+
 
 class DownloadBase:
     def __init__(self, fname, url, suffix=None, opt_args=None):
@@ -29,6 +45,8 @@ class DownloadBase:
         self.suffix = suffix
         self.title = None
         self.live_cover_path = None
+        # 本次录制的保存目录 由 output_root 和 output_layout 决定
+        self.output_dir = None
         self.downloader = config.get('downloader', 'stream-gears')
         # ffmpeg.exe -i  http://vfile1.grtn.cn/2018/1542/0254/3368/154202543368.ssm/154202543368.m3u8
         # -c copy -bsf:a aac_adtstoasc -movflags +faststart output.mp4
@@ -38,6 +56,15 @@ class DownloadBase:
         self.opt_args = opt_args
         # 是否是下载模式 跳过下播检测
         self.is_download = False
+        # 同一直播流的其他地址(如其他CDN节点) 由插件在check_stream中填写，录制停滞时切换
+        self.alternative_urls = []
+        # 上次录制是否因停滞而中断
+        self.stalled = False
+        # 本次录制中已经发送过分段事件的文件
+        self.closed_segments = set()
+        # 同时从两个CDN节点录制 结束后互相填补缺口
+        self.redundant_recording = config.get('streamers', {}).get(fname, {}).get(
+            'redundant_recording', config.get('redundant_recording', False))
         self.live_cover_url = None
         self.fake_headers = {
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
@@ -80,11 +107,20 @@ class DownloadBase:
             return filename
 
     def download(self, filename):
-        filename = self.get_filename()
+        if self.output_dir is None:
+            self.output_dir = output_dir(self.fname, self.__class__.__name__)
+        filename = os.path.join(self.output_dir, self.get_filename())
         fmtname = time.strftime(filename.encode("unicode-escape").decode()).encode().decode("unicode-escape")
 
+        if self.native_flv():
+            # 文件名在每个分段开始时才确定 弹幕随分段重新开始录制
+            return self.native_download()
         self.danmaku_download_start(fmtname)
+        if self.danmaku is not None:
+            catalog.add(self.fname, f'{fmtname}.xml')
 
+        if self.downloader in ('streamlink', 'ffmpeg'):
+            catalog.add(self.fname, f'{fmtname}.{self.suffix}')
         if self.downloader == 'streamlink':
             parsed_url = urlparse(self.raw_stream_url)
             path = parsed_url.path
@@ -94,6 +130,10 @@ class DownloadBase:
                 return self.streamlink_download(fmtname)
         elif self.downloader == 'ffmpeg':
             return self.ffmpeg_download(fmtname)
+        elif self.downloader == 'native':
+            # 其他格式的直播流回退到ffmpeg
+            catalog.add(self.fname, f'{fmtname}.{self.suffix}')
+            return self.ffmpeg_download(fmtname)
 
         stream_gears_download(self.raw_stream_url, self.fake_headers, filename, config.get('segment_time'),
                               config.get('file_size'))
@@ -103,7 +143,8 @@ class DownloadBase:
         streamlink_input_args = ['--stream-segment-threads', '3', '--hls-playlist-reload-attempts', '1']
         streamlink_cmd = ['streamlink', *streamlink_input_args, self.raw_stream_url, 'best', '-O']
         ffmpeg_input_args = ['-rw_timeout', '20000000']
-        ffmpeg_cmd = ['ffmpeg', '-re', '-i', 'pipe:0', '-y', *ffmpeg_input_args, *self.default_output_args,
+        ffmpeg_cmd = ['ffmpeg', '-progress', 'pipe:1', '-nostats', '-re', '-i', 'pipe:0', '-y',
+                      *ffmpeg_input_args, *self.default_output_args,
                       *self.opt_args, '-c', 'copy', '-f', self.suffix]
         # if config.get('segment_time'):
         #     ffmpeg_cmd += ['-f', 'segment',
@@ -114,67 +155,265 @@ class DownloadBase:
         ffmpeg_cmd += [f'{filename}.{self.suffix}.part']
         streamlink_proc = subprocess.Popen(streamlink_cmd, stdout=subprocess.PIPE)
         ffmpeg_proc = subprocess.Popen(ffmpeg_cmd, stdin=streamlink_proc.stdout, stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT)
+                                       stderr=subprocess.PIPE)
+        # ffmpeg 持有管道的读端即可
+        streamlink_proc.stdout.close()
+        return self.wait_ffmpeg(ffmpeg_proc)
+
+    def wait_ffmpeg(self, proc, backup=False):
+        """ffmpeg 的输出由 supervisor 统一读取 这里只等待进程结束，backup 为双CDN录制中的备用录制"""
+        name = f'{self.fname}-backup' if backup else self.fname
+        supervised = supervisor.watch(proc, name, progress=proc.stdout, log=proc.stderr)
+        # 输出停止增长超过 stall_timeout 秒即判定为停滞 不必等待 -rw_timeout
+        stall_timeout = config.get('stall_timeout', 6)
+        terminated = None
         try:
-            with ffmpeg_proc.stdout as stdout:
-                for line in iter(stdout.readline, b''):
-                    decode_line = line.decode(errors='ignore')
-                    print(decode_line, end='', file=sys.stderr)
-                    logger.debug(decode_line.rstrip())
-            retval = ffmpeg_proc.wait()
+            while True:
+                retval = supervised.wait(1 if stall_timeout else None)
+                if retval is not None:
+                    break
+                if terminated is None and supervised.stalled(stall_timeout):
+                    logger.warning(f'{name} 录制停滞超过 {stall_timeout} 秒，重新连接')
+                    if not backup:
+                        # 备用录制停滞不影响主录制 不触发重连
+                        self.stalled = True
+                    terminated = time.monotonic()
+                    proc.terminate()
+                elif terminated is not None and time.monotonic() - terminated > 5:
+                    proc.kill()
         except KeyboardInterrupt:
-            if sys.platform != 'win32':
-                ffmpeg_proc.communicate(b'q')
+            if sys.platform != 'win32' and proc.stdin:
+                proc.stdin.write(b'q')
+                proc.stdin.flush()
             raise
+        finally:
+            supervisor.release(supervised)
         if retval != 0:
+            logger.warning(f'{name} ffmpeg 退出码 {retval}，最近的输出:\n{supervised.tail()}')
             return False
+        logger.debug(f'{name} ffmpeg 结束 {supervised.stats}')
         return True
 
     def ffmpeg_download(self, filename):
-        default_input_args = ['-headers', ''.join('%s: %s\r\n' % x for x in self.fake_headers.items()), '-rw_timeout',
-                              '20000000']
-        parsed_url = urlparse(self.raw_stream_url)
-        path = parsed_url.path
-        if '.m3u8' in path:
-            default_input_args += ['-max_reload', '1000']
-        args = ['ffmpeg', '-y', *default_input_args,
-                '-i', self.raw_stream_url, *self.default_output_args, *self.opt_args,
-                '-c', 'copy', '-f', self.suffix]
+        if self.redundant_recording and self.suffix == 'flv' and self.alternative_urls:
+            return self.redundant_download(filename)
         # if config.get('segment_time'):
         #     args += ['-f', 'segment',
         #              f'{filename} part-%03d.{self.suffix}']
         # else:
         #     args += [
         #         f'{filename}.{self.suffix}.part']
-        args += [f'{filename}.{self.suffix}.part']
+        proc = self.ffmpeg_process(self.raw_stream_url, f'{filename}.{self.suffix}.part')
+        return self.wait_ffmpeg(proc)
 
-        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    def ffmpeg_process(self, url, output):
+        default_input_args = ['-headers', ''.join('%s: %s\r\n' % x for x in self.fake_headers.items()), '-rw_timeout',
+                              '20000000']
+        parsed_url = urlparse(url)
+        path = parsed_url.path
+        if '.m3u8' in path:
+            default_input_args += ['-max_reload', '1000']
+        args = ['ffmpeg', '-progress', 'pipe:1', '-nostats', '-y', *default_input_args,
+                '-i', url, *self.default_output_args, *self.opt_args,
+                '-c', 'copy', '-f', self.suffix, output]
+        return subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def redundant_download(self, filename):
+        """
+        同时从当前地址和另一个CDN节点录制，备用录制的扩展名不是视频格式，不会加入索引或上传。
+        录制结束后以当前地址的录制为主，缺口由备用录制填补
+        """
+        part = f'{filename}.{self.suffix}.part'
+        backup = f'{filename}.{self.suffix}.backup'
+        backup_url = self.alternative_urls[0]
+        logger.info(f'{self.fname} 同时从 {urlparse(backup_url).netloc} 录制备用文件')
+        result = {}
+
+        def record_backup():
+            result['ok'] = self.wait_ffmpeg(self.ffmpeg_process(backup_url, backup), backup=True)
+
+        thread = threading.Thread(target=record_backup, name=f'{self.fname}-backup', daemon=True)
+        thread.start()
+        try:
+            ok = self.wait_ffmpeg(self.ffmpeg_process(self.raw_stream_url, part))
+        finally:
+            thread.join()
+        self.merge_backup(part, backup)
+        return ok or result.get('ok', False)
+
+    def merge_backup(self, part, backup):
+        if not os.path.exists(backup):
+            return
+        merged = f'{part}.merge'
         try:
-            with proc.stdout as stdout:
-                for line in iter(stdout.readline, b''):  # b'\n'-separated lines
-                    decode_line = line.decode(errors='ignore')
-                    print(decode_line, end='', file=sys.stderr)
-                    logger.debug(decode_line.rstrip())
-            retval = proc.wait()
+            filled = flv.merge(part, backup, merged)
+        except (OSError, ValueError):
+            logger.exception(f'{self.fname} 合并备用录制失败')
+            filled = None
+        try:
+            if filled is not None:
+                os.replace(merged, part)
+                if filled:
+                    logger.info(f'{self.fname} 由备用录制补充了 {filled / 1000:.1f} 秒')
+            else:
+                # 无法对齐时保留较大的一份
+                if not os.path.exists(part) or os.path.getsize(backup) > os.path.getsize(part):
+                    logger.warning(f'{self.fname} 两份录制无法对齐，使用备用录制')
+                    os.replace(backup, part)
+                else:
+                    logger.warning(f'{self.fname} 两份录制无法对齐，丢弃备用录制')
+        finally:
+            for name in (merged, backup):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def native_download(self):
+        """不启动ffmpeg 在共用的事件循环中直接录制 HTTP-FLV 直播流"""
+        segment_time = config.get('segment_time')
+        if segment_time:
+            hours, minutes, seconds = map(int, segment_time.split(':'))
+            segment_time = hours * 60 * 60 + minutes * 60 + seconds
+        file_size = config.get('file_size')
+        if not segment_time and not file_size:
+            file_size = 8 * 1024 * 1024 * 1024
+        placed = contextlib.ExitStack()
+
+        def new_name():
+            # 每个分段重新选择磁盘和按日期等布局的目录
+            placed.close()
+            volume = placed.enter_context(placement.place())
+            self.output_dir = output_dir(self.fname, self.__class__.__name__, root=volume)
+            return os.path.join(self.output_dir, f'{self.file_name}.{self.suffix}')
+
+        def restart_danmaku(name):
+            # close 还会结束插件的其他进程 这里只停止上个分段的弹幕
+            if self.danmaku is not None:
+                self.danmaku.stop()
+                self.danmaku = None
+            root = os.path.splitext(name)[0]
+            self.danmaku_download_start(root)
+            if self.danmaku is not None:
+                catalog.add(self.fname, f'{root}.xml')
+
+        # 停止弹幕录制需要等待写入完成、发送事件可能等待队列 都不在录制的事件循环中进行
+        events = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{self.fname}-segments')
+
+        def on_open(name):
+            # 登记去重后实际使用的文件名
+            catalog.add(self.fname, name)
+            events.submit(restart_danmaku, name)
+
+        def on_close(name):
+            # 与索引中的文件名一致 录制结束时不会重复发送
+            events.submit(self.close_segments, [os.path.normpath(name)])
+
+        writer = flv.FlvWriter(new_name, segment_time, file_size and int(file_size),
+                               on_open=on_open, on_close=on_close)
+        future = httpflv.loop_thread.submit(
+            httpflv.record(self.raw_stream_url, self.fake_headers, writer, config.get('stall_timeout', 6) or 20))
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            logger.warning(f'{self.fname} 录制停滞，重新连接')
+            self.stalled = True
+        except (aiohttp.ClientError, ValueError) as e:
+            logger.warning(f'{self.fname} 录制中断 {e!r}')
         except KeyboardInterrupt:
-            if sys.platform != 'win32':
-                proc.communicate(b'q')
+            future.cancel()
             raise
-        if retval != 0:
-            return False
-        return True
+        finally:
+            placed.close()
+            events.shutdown()
+        return False
+
+    def native_flv(self):
+        """是否由 native 下载器直接录制"""
+        return (self.downloader == 'native' and self.suffix == 'flv'
+                and '.flv' in urlparse(self.raw_stream_url).path)
+
+    def switch_stream_url(self):
+        """停滞后换用其他地址重连 没有其他地址时沿用当前地址"""
+        if self.alternative_urls:
+            self.alternative_urls.append(self.raw_stream_url)
+            self.raw_stream_url = self.alternative_urls.pop(0)
+            logger.info(f'{self.fname} 切换直播流地址 {urlparse(self.raw_stream_url).netloc}')
 
     def danmaku_download_start(self, filename):
         pass
 
-    def run(self):
-        if not self.check_stream():
+    def run(self, reconnect=False):
+        # 停滞后的快速重连直接使用上次获取的直播流地址 不再完整检测
+        if not (reconnect and self.raw_stream_url) and not self.check_stream():
             return False
-        file_name = self.file_name
-        retval = self.download(file_name)
-        self.rename(f'{file_name}.{self.suffix}')
+        existing = set(catalog.files(self.fname))
+        self.closed_segments = set()
+        start = time.monotonic()
+        # 每次录制(ffmpeg为每个分段)重新选择磁盘 native 在每个分段开始时自行选择
+        with (contextlib.nullcontext() if self.native_flv() else placement.place()) as volume:
+            self.output_dir = output_dir(self.fname, self.__class__.__name__, root=volume)
+            file_name = os.path.join(self.output_dir, self.file_name)
+            stop = threading.Event()
+            if self.downloader == 'stream-gears':
+                # 在一次下载中自行分段 定期查找已经写完的分段 native 直接录制时由写入器通知
+                threading.Thread(target=self.watch_segments, args=(existing, stop),
+                                 name=f'{self.fname}-segments', daemon=True).start()
+            try:
+                retval = self.download(file_name)
+                self.rename(f'{file_name}.{self.suffix}')
+            finally:
+                stop.set()
+                # stream_gears、yt-dlp 等自行命名的分段按文件名模板加入索引
+                catalog.scan(self.fname, self.get_filename(), self.output_dir)
+                self.record_metrics(existing, time.monotonic() - start)
+                self.close_segments(self.new_segments(existing))
         return retval
 
+    def new_segments(self, existing):
+        """本次录制产生的已完成的视频分段 按创建时间排序"""
+        return [name for name in catalog.files(self.fname)
+                if name not in existing and os.path.splitext(name)[1] in media_extensions]
+
+    def watch_segments(self, existing, stop, interval=30):
+        mtime = None
+        while not stop.wait(interval):
+            try:
+                # 新建或更名分段时目录的修改时间才会变化 其余时候不必扫描目录
+                current = os.stat(self.output_dir).st_mtime_ns
+                if current == mtime:
+                    continue
+                mtime = current
+                catalog.scan(self.fname, self.get_filename(), self.output_dir)
+                # 最新的分段仍在写入
+                self.close_segments(self.new_segments(existing)[:-1])
+            except Exception:
+                logger.exception('查找已完成的分段失败')
+
+    def close_segments(self, segments):
+        for segment in segments:
+            if segment not in self.closed_segments:
+                self.closed_segments.add(segment)
+                self.segment_closed(segment)
+
+    def segment_closed(self, filename):
+        """分段写入完成，录制仍在继续时即可开始上传"""
+        if not config.get('upload_segments', True):
+            return
+        from biliup.downloader import send_segment_event
+        send_segment_event({'name': self.fname, 'url': self.url}, filename)
+
+    def record_metrics(self, existing, duration):
+        size = 0
+        for name in set(catalog.files(self.fname)) - existing:
+            try:
+                size += os.path.getsize(name)
+            except OSError:
+                pass
+        plugin = self.__class__.__name__
+        recorded_bytes.inc(size, streamer=self.fname, plugin=plugin)
+        recording_seconds.observe(duration, plugin=plugin)
+        if duration > 0:
+            recording_bitrate.set(size * 8 / duration, streamer=self.fname)
+
     def start(self):
         logger.info(f'开始下载：{self.__class__.__name__} - {self.fname}')
         date = time.localtime()
@@ -182,19 +421,35 @@ class DownloadBase:
         delay = int(config.get('delay', 0))
         # 重试次数
         retry_count = 0
-        # delay 重试次数
-        retry_count_delay = 0
-        # delay 总重试次数 向上取整
-        delay_all_retry_count = -(-delay // 60)
+        # 获取流失败后的重试间隔 1、2、4秒
+        retry_backoff = Backoff(1, config.get('retry_backoff_max', 10))
+        # 下播延迟检测的开始时间 检测间隔从5秒逐渐增加到60秒
+        delay_start = None
+        delay_backoff = Backoff(5, 60)
+        # 连续快速重连次数
+        reconnect = False
+        reconnect_count = 0
 
         while True:
             ret = False
+            started = time.monotonic()
             try:
-                ret = self.run()
+                ret = self.run(reconnect)
             except:
                 logger.exception('Uncaught exception:')
             finally:
                 self.close()
+            reconnect = False
+            if self.stalled:
+                self.stalled = False
+                if time.monotonic() - started > 60:
+                    # 正常录制了一段时间后才停滞
+                    reconnect_count = 0
+                if reconnect_count < 3:
+                    reconnect_count += 1
+                    self.switch_stream_url()
+                    reconnect = True
+                    continue
             if ret:
                 if self.is_download:
                     # 成功下载后也不检测下一个需要下载的视频而是先上传等待下次检测保证上传时使用下载视频的标题
@@ -202,7 +457,10 @@ class DownloadBase:
                     break
                 # 成功下载重置重试次数
                 retry_count = 0
-                retry_count_delay = 0
+                reconnect_count = 0
+                retry_backoff.reset()
+                delay_start = None
+                delay_backoff.reset()
             else:
                 if self.is_download:
                     # 下载模式如果下载失败直接跳出
@@ -210,29 +468,24 @@ class DownloadBase:
 
                 if retry_count < 3:
                     retry_count += 1
+                    wait = retry_backoff.next()
                     logger.info(
-                        f'获取流失败：{self.__class__.__name__} - {self.fname}，重试次数 {retry_count} / 3，等待 10 秒')
-                    time.sleep(10)
+                        f'获取流失败：{self.__class__.__name__} - {self.fname}，重试次数 {retry_count} / 3，等待 {wait} 秒')
+                    time.sleep(wait)
                     continue
 
                 if delay:
-                    retry_count_delay += 1
-                    if retry_count_delay > delay_all_retry_count:
+                    if delay_start is None:
+                        delay_start = time.monotonic()
+                        end_time = time.localtime()
+                        logger.info(
+                            f'下播延迟检测：{self.__class__.__name__} - {self.fname}，{delay} 秒内持续检测开播状态')
+                    remaining = delay - (time.monotonic() - delay_start)
+                    if remaining <= 0:
                         logger.info(f'下播延迟检测结束：{self.__class__.__name__}:{self.fname}')
                         break
-                    else:
-                        if delay < 60:
-                            logger.info(
-                                f'下播延迟检测：{self.__class__.__name__} - {self.fname}，将在 {delay} 秒后检测开播状态')
-                            time.sleep(delay)
-                        else:
-                            if retry_count_delay == 1:
-                                end_time = time.localtime()
-                                # 只有第一次显示
-                                logger.info(
-                                    f'下播延迟检测：{self.__class__.__name__} - {self.fname}，每隔 60 秒检测开播状态，共检测 {delay_all_retry_count} 次')
-                            time.sleep(60)
-                        continue
+                    time.sleep(min(delay_backoff.next(), remaining))
+                    continue
                 else:
                     end_time = time.localtime()
                     break
@@ -279,6 +532,7 @@ class DownloadBase:
                             f.write(response.content)
 
                     if suffix == 'webp':
+                        from PIL import Image
                         with Image.open(live_cover_path) as img:
                             img = img.convert('RGB')
                             img.save(f'{save_dir}{fmtname}.jpg', format='JPEG')
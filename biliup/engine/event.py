@@ -1,23 +1,37 @@
 # encoding: UTF-8
 # 系统模块
 import inspect
+import logging
+from collections import deque
 from collections.abc import Generator
 from concurrent.futures.thread import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from queue import Queue
 from threading import *
+from typing import Any
 import functools
 
+from ..common.metrics import metrics
+
+logger = logging.getLogger('biliup')
+
+coalesced_events = metrics.counter('biliup_events_coalesced_total', '与等待中的事件合并而丢弃的事件数', ('type',))
+
 
 class EventManager(Thread):
-    def __init__(self, context=None, pool1_size=3, pool2_size=3):
+    def __init__(self, context=None, pool1_size=3, pool2_size=3, maxsize=1024):
         """初始化事件管理器"""
         super().__init__(name='Synchronous', daemon=True)
         if context is None:
             context = {}
         self.context = context
-        # 事件对象列表
-        self.__eventQueue = Queue()
+        # 每种事件一个有界队列 {事件类型: deque}
+        self.maxsize = maxsize
+        self.__queues = {}
+        # 等待中的事件的合并键 {(事件类型, key)}
+        self.__pending_keys = set()
+        # 事件类型的优先级 数值大的先分发
+        self.__priority = {}
+        self.__cond = Condition()
         # 事件管理器开关
         self.__active = True
         # 事件处理线程池1
@@ -25,6 +39,8 @@ class EventManager(Thread):
             'Asynchronous1': ThreadPoolExecutor(pool1_size, thread_name_prefix='Asynchronous1'),
             'Asynchronous2': ThreadPoolExecutor(pool2_size, thread_name_prefix='Asynchronous2')
         }
+        # 各线程池中 [正在执行, 等待执行] 的任务数
+        self._pool_tasks = {name: [0, 0] for name in self._pool}
         # 阻塞函数列表
         self.__block = []
 
@@ -35,10 +51,37 @@ class EventManager(Thread):
         self.__method = {}
 
     def run(self):
-        while self.__active:
-            event = self.__eventQueue.get()
-            if event is not None:
-                self.__event_process(event)
+        while True:
+            with self.__cond:
+                event = self.__next_event()
+                while self.__active and event is None:
+                    self.__cond.wait()
+                    event = self.__next_event()
+                if not self.__active:
+                    return
+            self.__event_process(event)
+
+    def __pools(self, type_):
+        return {handler.pool for handler in self.__handlers.get(type_, ())
+                if handler.__qualname__ in self.__block}
+
+    def __next_event(self):
+        """
+        按优先级取出下一个可以分发的事件 调用时需持有 __cond
+        处理函数所在线程池已满时事件留在队列中，积压可见且仍可合并，也不会阻塞其他类型的事件
+        """
+        for type_ in sorted(self.__queues, key=lambda t: self.__priority.get(t, 0), reverse=True):
+            queue = self.__queues[type_]
+            if not queue:
+                continue
+            if any(sum(self._pool_tasks[pool]) >= self._pool[pool]._max_workers for pool in self.__pools(type_)):
+                continue
+            event = queue.popleft()
+            self.__pending_keys.discard((type_, event.key))
+            # 通知因队列已满而等待的发送方
+            self.__cond.notify_all()
+            return event
+        return None
 
     def __event_process(self, event):
         """处理事件"""
@@ -48,15 +91,51 @@ class EventManager(Thread):
         # 若存在，则按顺序将事件传递给处理函数执行
         for handler in self.__handlers[event.type_]:
             if handler.__qualname__ in self.__block:
-                self._pool.get(handler.pool).submit(handler, event)
+                self.__submit(handler.pool, handler, event)
             else:
                 handler(event)
 
+    def __submit(self, pool, handler, event):
+        tasks = self._pool_tasks[pool]
+
+        def run():
+            with self.__cond:
+                tasks[1] -= 1
+                tasks[0] += 1
+            try:
+                return handler(event)
+            finally:
+                with self.__cond:
+                    tasks[0] -= 1
+
+        with self.__cond:
+            tasks[1] += 1
+        future = self._pool.get(pool).submit(run)
+        # 线程池有空闲后继续分发积压的事件
+        future.add_done_callback(self.__wakeup)
+
+    def __wakeup(self, *_):
+        with self.__cond:
+            self.__cond.notify_all()
+
+    def queue_depth(self, type_=None):
+        """等待分发的事件数 不指定类型时返回 {事件类型: 数量}"""
+        with self.__cond:
+            if type_ is not None:
+                return len(self.__queues.get(type_, ()))
+            return {t: len(queue) for t, queue in self.__queues.items()}
+
+    def pool_usage(self):
+        """{线程池: (正在执行, 等待执行, 线程数)}"""
+        with self.__cond:
+            return {name: (*self._pool_tasks[name], pool._max_workers) for name, pool in self._pool.items()}
+
     def stop(self):
         """停止"""
         # 将事件管理器设为停止
-        self.__active = False
-        self.__eventQueue.put(None)
+        with self.__cond:
+            self.__active = False
+            self.__cond.notify_all()
         for pool in self._pool.values():
             pool.shutdown()
 
@@ -90,8 +169,31 @@ class EventManager(Thread):
             pass
 
     def send_event(self, event):
-        """发送事件，向事件队列中存入事件"""
-        self.__eventQueue.put(event)
+        """
+        发送事件，向事件队列中存入事件
+        event.key 不为None时，若已有相同类型与key的事件在等待则合并，返回False
+        队列已满时阻塞直到有空位(分发线程自身发送时不阻塞)
+        """
+        with self.__cond:
+            key = (event.type_, event.key)
+            if event.key is not None and key in self.__pending_keys:
+                coalesced_events.inc(type=event.type_)
+                return False
+            queue = self.__queues.setdefault(event.type_, deque())
+            if len(queue) >= self.maxsize and current_thread() is not self:
+                logger.warning(f'{event.type_} 事件队列已满({len(queue)})，等待处理')
+                while self.__active and len(queue) >= self.maxsize:
+                    self.__cond.wait()
+            if event.key is not None:
+                self.__pending_keys.add(key)
+            queue.append(event)
+            self.__cond.notify_all()
+        return True
+
+    def set_priority(self, type_, priority):
+        """设置事件类型的优先级 数值大的先分发 默认为0"""
+        with self.__cond:
+            self.__priority[type_] = priority
 
     def register(self, type_, block=False):
         classname = inspect.getouterframes(inspect.currentframe())[1][3]
@@ -162,3 +264,4 @@ class Event:
     type_: str  # 事件类型
     args: tuple = ()
     dict: dict = field(default_factory=dict)  # 字典用于保存具体的事件数据
+    key: Any = None  # 合并键 同类型同key的事件在队列中最多只有一个
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+
+import aiohttp
+
+from ..common.flv import FlvParser
+from ..common.tools import LoopThread
+
+logger = logging.getLogger('biliup')
+
+# 所有 HTTP-FLV 录制共用一个事件循环线程和连接池
+loop_thread = LoopThread('HttpFlv')
+_session = None
+
+
+def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
+
+
+async def record(url, headers, writer, stall_timeout=20):
+    """
+    下载 HTTP-FLV 直播流并交给 writer(FlvWriter) 写入分段，每路直播流只占用解析缓冲区和文件缓冲区。
+    超过 stall_timeout 秒没有收到数据时抛出 asyncio.TimeoutError，直播流正常结束返回 True
+    """
+    timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=stall_timeout or None)
+    parser = FlvParser()
+    try:
+        async with _get_session().get(url, headers=headers, timeout=timeout) as response:
+            response.raise_for_status()
+            while True:
+                data = await response.content.readany()
+                if not data:
+                    break
+                for tag in parser.feed(data):
+                    if writer.header is None:
+                        writer.write_header(parser.header)
+                    writer.write(tag)
+    finally:
+        writer.close()
+    return writer.header is not None
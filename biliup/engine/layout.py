@@ -0,0 +1,123 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from biliup.config import config
+
+logger = logging.getLogger('biliup')
+
+
+def output_root():
+    return config.get('output_root', '.')
+
+
+def output_volumes():
+    """可用于保存录播的所有根目录 设置了 output_volumes 时 output_root 仅作为默认值"""
+    return config.get('output_volumes') or [output_root()]
+
+
+def output_dir(streamer, platform='', date=None, root=None):
+    """
+    录播文件的保存目录 root/output_layout，root 默认为 output_root
+    output_layout 支持 {platform} {streamer} 以及时间格式化符号，例如 {platform}/{streamer}/%Y-%m-%d
+    未设置时所有文件保存在 output_root 下
+    """
+    if root is None:
+        root = output_root()
+    layout = config.get('output_layout')
+    if not layout:
+        directory = root
+    else:
+        parts = []
+        for part in re.split(r'[/\\]', layout):
+            part = part.format(platform=platform, streamer=streamer)
+            part = time.strftime(part.encode('unicode-escape').decode(), date or time.localtime()) \
+                .encode().decode('unicode-escape')
+            # 目录名中不能出现路径分隔符等特殊字符
+            part = re.sub(r'[<>:"/\\|?*]', '', part).strip()
+            if part and part not in ('.', '..'):
+                parts.append(part)
+        directory = os.path.join(root, *parts)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def layout_depth():
+    """output_root 下的目录层数"""
+    layout = config.get('output_layout')
+    if not layout:
+        return 0
+    return len([part for part in re.split(r'[/\\]', layout) if part])
+
+
+def iter_output_files():
+    """遍历所有录播根目录下按布局保存的文件 只深入布局对应的层数"""
+    depth = layout_depth()
+    stack = [(root, 0) for root in dict.fromkeys(output_volumes())]
+    while stack:
+        directory, level = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                if level < depth:
+                    stack.append((entry.path, level + 1))
+            elif entry.is_file():
+                yield entry
+
+
+class StoragePlacement:
+    """
+    在 output_volumes 配置的多个根目录(通常位于不同磁盘)之间分配录制任务。
+    每个分段开始时选择 当前写入数 / 剩余空间 最小的根目录，剩余空间低于 output_min_free(GB) 的根目录不再写入，
+    因此磁盘写满后下一个分段会自动换到其他磁盘。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = Counter()
+
+    @staticmethod
+    def _free(volume):
+        try:
+            os.makedirs(volume, exist_ok=True)
+            return shutil.disk_usage(volume).free
+        except OSError:
+            logger.exception(f'无法使用录播目录 {volume}')
+            return 0
+
+    def select(self):
+        # 调用时需持有 _lock
+        volumes = output_volumes()
+        if len(volumes) == 1:
+            return volumes[0]
+        min_free = config.get('output_min_free', 5) * 1024 ** 3
+        free = {volume: self._free(volume) for volume in volumes}
+        candidates = [volume for volume in volumes if free[volume] >= min_free]
+        if not candidates:
+            volume = max(volumes, key=free.get)
+            logger.warning(f'所有录播目录剩余空间不足 {min_free / 1024 ** 3:.0f}GB，使用剩余空间最多的 {volume}')
+            return volume
+        return min(candidates, key=lambda v: (self._active[v] + 1) / free[v])
+
+    @contextmanager
+    def place(self):
+        """在选出的根目录中录制一个分段"""
+        with self._lock:
+            volume = self.select()
+            self._active[volume] += 1
+        try:
+            yield volume
+        finally:
+            with self._lock:
+                self._active[volume] -= 1
+
+
+placement = StoragePlacement()
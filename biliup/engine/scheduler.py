@@ -0,0 +1,245 @@
+import asyncio
+import heapq
+import inspect
+import itertools
+import logging
+import random
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from urllib.error import HTTPError
+
+from biliup.config import config
+from ..common.metrics import metrics
+from ..common.tools import TokenBucket
+from .download import DownloadBase
+
+logger = logging.getLogger('biliup')
+
+check_seconds = metrics.histogram('biliup_check_seconds', '开播检测耗时', ('plugin',))
+check_total = metrics.counter('biliup_checks_total', '开播检测次数 result为live/offline/error', ('plugin', 'result'))
+
+
+def per_platform(value, name, default):
+    """配置项既可以是统一的值 也可以是 {插件名: 值} 的字典"""
+    if isinstance(value, dict):
+        return value.get(name, value.get('default', default))
+    if value is None:
+        return default
+    return value
+
+
+class CheckScheduler:
+    """
+    单事件循环的开播检测调度器
+    每个url(支持批量检测的平台则是每个平台)在堆中保存下一次检测的截止时间
+    到期后在平台的并发上限与令牌桶预算内并发执行check_stream
+    """
+
+    def __init__(self, context, stop_flag):
+        self.context = context
+        self.stop_flag = stop_flag
+        # 同一url两次检测的间隔
+        self.interval = config.get('event_loop_interval', 30)
+        # 间隔随机抖动比例 避免同一时刻集中请求
+        self.jitter = config.get('checker_jitter', 0.1)
+        checker_sleep = config.get('checker_sleep', 10)
+        # 兼容旧配置 未设置checker_rate时按checker_sleep换算为每秒请求数
+        self._rate = config.get('checker_rate', 1 / checker_sleep if checker_sleep else 0)
+        self._burst = config.get('checker_burst')
+        self._concurrency = config.get('checker_concurrency', 3)
+        self._loop = None
+        self._heap = []
+        self._scheduled = set()
+        self._counter = itertools.count()
+        self._buckets = {}
+        self._semaphores = {}
+        self._tasks = set()
+        self._executor = None
+        self._workers = 0
+        self._wakeup = None
+
+    @staticmethod
+    def plugin_class(plugin):
+        # Plugin.download 装饰后的插件通过 functools.wraps 保留了原始类，叠加多个装饰器时需逐层展开
+        return inspect.unwrap(plugin)
+
+    def is_batch(self, plugin):
+        return DownloadBase.batch_check != getattr(self.plugin_class(plugin), DownloadBase.batch_check.__name__)
+
+    def schedule(self, name, url=None, delay=0.):
+        key = (name, url)
+        if key in self._scheduled:
+            return
+        self._scheduled.add(key)
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), name, url))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def refresh(self):
+        """根据context['checker']补充尚未调度的检测项 已移除的检测项会在出堆时丢弃"""
+        for name, plugin in self.context['checker'].items():
+            if self.is_batch(plugin):
+                self.schedule(name)
+                continue
+            for url in plugin.url_list:
+                self.schedule(name, url)
+
+    def reload(self):
+        """
+        配置文件重新加载后调用 可以在其他线程中调用
+        更新检测间隔与限速，并调度新增的url
+        """
+        if self._loop is not None and self._loop.is_running():
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not self._loop:
+                self._loop.call_soon_threadsafe(self.reload)
+                return
+        self.interval = config.get('event_loop_interval', 30)
+        self.jitter = config.get('checker_jitter', 0.1)
+        checker_sleep = config.get('checker_sleep', 10)
+        self._rate = config.get('checker_rate', 1 / checker_sleep if checker_sleep else 0)
+        self._burst = config.get('checker_burst')
+        self._concurrency = config.get('checker_concurrency', 3)
+        # 下次检测时按新配置创建 正在进行的检测仍使用原来的
+        self._semaphores.clear()
+        self._buckets.clear()
+        if self._executor is not None:
+            self._resize_executor()
+        self.refresh()
+
+    def _resize_executor(self):
+        """线程数为各平台并发上限之和 新增平台或调高并发后换用更大的线程池，线程按需创建所以只增不减"""
+        workers = max(sum(
+            max(int(per_platform(self._concurrency, name, 3)), 1) for name in self.context['checker']), 1)
+        if workers <= self._workers:
+            return
+        executor = self._executor
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='checker')
+        self._workers = workers
+        if executor is not None:
+            # 已提交的检测在原来的线程池中执行完
+            executor.shutdown(wait=False)
+
+    def _next_delay(self):
+        return max(self.interval * (1 + random.uniform(-self.jitter, self.jitter)), 0)
+
+    def _limits(self, name):
+        if name not in self._semaphores:
+            concurrency = per_platform(self._concurrency, name, 3)
+            rate = per_platform(self._rate, name, 0.1)
+            burst = per_platform(self._burst, name, concurrency)
+            self._semaphores[name] = asyncio.Semaphore(max(int(concurrency), 1))
+            self._buckets[name] = TokenBucket(rate, burst)
+        return self._semaphores[name], self._buckets[name]
+
+    def _is_recording(self, url):
+        # 同一主播多个url 多个url只能同时下载一个
+        context = self.context
+        streamer_urls = context['streamers'][context['inverted_index'][url]]['url']
+        for streamer_url in streamer_urls:
+            if context['url_status'][streamer_url] == 1:
+                logger.debug(f'{url}-{streamer_url}-正在下载中，跳过检测')
+                return True
+        return False
+
+    def _probe(self, plugin, url):
+        from biliup.downloader import send_download_event
+        name = self.context['inverted_index'][url]
+        result = 'error'
+        start = time.perf_counter()
+        # 某个检测异常略过不应影响其他检测
+        try:
+            if plugin(name, url).check_stream(True):
+                result = 'live'
+                send_download_event(name, url)
+            else:
+                result = 'offline'
+        except HTTPError as e:
+            logger.error(f'{plugin.__module__} {e.url} => {e}')
+        except IOError:
+            logger.exception("IOError")
+        except:
+            logger.exception("Uncaught exception:")
+        finally:
+            check_seconds.observe(time.perf_counter() - start, plugin=plugin.__name__)
+            check_total.inc(plugin=plugin.__name__, result=result)
+
+    def _batch_probe(self, plugin, check_urls):
+        from biliup.downloader import send_download_event
+        inverted_index = self.context['inverted_index']
+        live = 0
+        start = time.perf_counter()
+        try:
+            for url in self.plugin_class(plugin).batch_check(check_urls):
+                live += 1
+                send_download_event(inverted_index[url], url)
+        except:
+            logger.exception("Uncaught exception:")
+            check_total.inc(plugin=plugin.__name__, result='error')
+        else:
+            check_total.inc(len(check_urls) - live, plugin=plugin.__name__, result='offline')
+        finally:
+            check_seconds.observe(time.perf_counter() - start, plugin=plugin.__name__)
+            check_total.inc(live, plugin=plugin.__name__, result='live')
+
+    async def _check(self, name, plugin, url):
+        loop = asyncio.get_running_loop()
+        semaphore, bucket = self._limits(name)
+        try:
+            async with semaphore:
+                await bucket.aacquire()
+                if url is None:
+                    check_urls = [u for u in plugin.url_list if not self._is_recording(u)]
+                    if check_urls:
+                        await loop.run_in_executor(self._executor, self._batch_probe, plugin, check_urls)
+                elif not self._is_recording(url):
+                    await loop.run_in_executor(self._executor, self._probe, plugin, url)
+        except:
+            logger.exception("Uncaught exception:")
+        finally:
+            self._scheduled.discard((name, url))
+            self.schedule(name, url, self._next_delay())
+
+    def _pop_due(self):
+        _, _, name, url = heapq.heappop(self._heap)
+        plugin = self.context['checker'].get(name)
+        if plugin is None or (url is not None and url not in plugin.url_list):
+            # 配置变更后已不再由该插件检测
+            self._scheduled.discard((name, url))
+            return None
+        if url is not None and self._is_recording(url):
+            self._scheduled.discard((name, url))
+            self.schedule(name, url, self._next_delay())
+            return None
+        return name, plugin, url
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._resize_executor()
+        self.refresh()
+        try:
+            while not self.stop_flag.is_set():
+                timeout = 1.
+                if self._heap:
+                    timeout = min(self._heap[0][0] - time.monotonic(), timeout)
+                if timeout > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                due = self._pop_due()
+                if due is None:
+                    continue
+                task = asyncio.create_task(self._check(*due))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            self._executor.shutdown(wait=False)
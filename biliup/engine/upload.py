@@ -1,16 +1,21 @@
+import asyncio
+import itertools
 import logging
 import os
 import shutil
 import subprocess
 import json
+import threading
 import time
 
-from functools import reduce
+from functools import partial, reduce
 from pathlib import Path
 from typing import NamedTuple, Optional, List
 
-from biliup.common.tools import NamedLock
+from biliup.common.timer import Timer
+from biliup.common.tools import NamedLock, TokenBucket
 from biliup.config import config
+from .catalog import catalog, media_extensions
 
 logger = logging.getLogger('biliup')
 
@@ -29,20 +34,16 @@ class UploadBase:
     @staticmethod
     def file_list(index) -> List[FileInfo]:
         from biliup.handler import event_manager
-        media_extensions = ['.mp4', '.flv', '.3gp', '.webm', '.mkv', '.ts']
 
-        # 获取文件列表
-        file_list = []
-        for file_name in os.listdir('.'):
-            if index in file_name and os.path.isfile(file_name):
-                file_list.append(file_name)
+        # 获取文件列表 按创建时间排序
+        file_list = catalog.files(index)
         if len(file_list) == 0:
             return []
-        file_list = sorted(file_list, key=lambda x: os.path.getctime(x))
 
         # 正在上传的文件列表
         upload_filename: list = event_manager.context['upload_filename']
 
+        file_set = set(file_list)
         results = []
         for index, file in enumerate(file_list):
             old_name = file
@@ -71,27 +72,22 @@ class UploadBase:
 
             video = file
             danmaku = None
-            if f'{name}.xml' in file_list:
+            if f'{name}.xml' in file_set:
                 danmaku = f'{name}.xml'
 
             result = UploadBase.FileInfo(video=video, danmaku=danmaku)
             results.append(result)
 
         # 过滤弹幕
+        danmaku_set = {result.danmaku for result in results}
         for file in file_list:
             name, ext = os.path.splitext(file)
             # 过滤正在上传的
             if name in upload_filename:
                 continue
-            if ext == '.xml':
-                have_video = False
-                for result in results:
-                    if result.danmaku == file:
-                        have_video = True
-                        break
-                if not have_video:
-                    logger.info(f'无视频，过滤删除 - {file}')
-                    UploadBase.remove_file(file)
+            if ext == '.xml' and file not in danmaku_set:
+                logger.info(f'无视频，过滤删除 - {file}')
+                UploadBase.remove_file(file)
         return results
 
     @staticmethod
@@ -105,6 +101,7 @@ class UploadBase:
     def remove_file(file: str):
         try:
             os.remove(file)
+            catalog.discard(file)
             logger.info(f'删除 - {file}')
         except:
             logger.warning(f'删除失败 - {file}')
@@ -112,6 +109,26 @@ class UploadBase:
     def upload(self, file_list: List[FileInfo]) -> List[FileInfo]:
         raise NotImplementedError()
 
+    def upload_segment(self, file: str):
+        """
+        录制过程中预先上传已完成的分段，提交时 upload 不必再上传该文件
+        需要上传插件支持保存上传结果，默认不预先上传
+        """
+        pass
+
+    def start_segment(self, file: str):
+        if config['streamers'].get(self.principal, {}).get('downloaded_processor'):
+            # 下载后处理可能修改或合并文件 预先上传的内容会与提交时不一致
+            return
+        try:
+            file_size = os.path.getsize(file) / 1024 / 1024
+        except OSError:
+            return
+        if file_size <= config.get('filtering_threshold', 0):
+            return
+        logger.info(f'分段录制完成，开始上传 - {file}')
+        self.upload_segment(file)
+
     def start(self):
         from biliup.handler import event_manager
         # 保证一个name同时只有一个上传线程扫描文件列表
@@ -135,6 +152,7 @@ class UploadBase:
                         "file_list": [file.video for file in file_list]
                     }, ensure_ascii=False))
                     # 后处理完成后重新扫描文件列表
+                    catalog.rescan(self.principal)
                     file_list = UploadBase.file_list(self.principal)
 
                 if len(file_list) > 0:
@@ -182,6 +200,7 @@ class UploadBase:
                         dest.mkdir(parents=True, exist_ok=True)
                     try:
                         shutil.move(path, dest / path.name)
+                        catalog.discard(file)
                     except Exception as e:
                         logger.exception(e)
                         continue
@@ -196,3 +215,161 @@ class UploadBase:
                 except subprocess.CalledProcessError as e:
                     logger.exception(e.output)
                     continue
+
+
+class UploadScheduler:
+    """
+    进程内所有上传任务共享的带宽调度，分片上传前需先申请额度，可在多个线程的事件循环中使用。
+    upload_rate_limit 限制总上传速度(MB/s)；upload_rate_cap_recording 为可选的录制期间上限，
+    只在设置后且有直播正在录制时生效，不会根据带宽自动推算。upload_chunks 限制同时上传的分片总数。
+    额度不足时按主播的 upload_priority 权重公平分配：每个主播累计 已上传字节/权重，值最小的优先。
+    """
+    # 修改 upload_chunks 等设置不会唤醒等待中的任务 最多等待这么久后重新检查
+    recheck_interval = 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bucket = TokenBucket(0)
+        self._counter = itertools.count()
+        self._waiting = {}
+        # 排在最前面但暂时无法上传的任务 {ticket: future}
+        self._sleeping = {}
+        self._vtime = {}
+        self._clock = 0.
+        self._in_flight = 0
+
+    @staticmethod
+    def _recording():
+        from biliup.handler import event_manager
+        return any(status == 1 for status in event_manager.context.get('url_status', {}).values())
+
+    def _rate(self):
+        rate = config.get('upload_rate_limit', 0)
+        recording_cap = config.get('upload_rate_cap_recording')
+        if recording_cap and self._recording():
+            rate = min(rate, recording_cap) if rate else recording_cap
+        return rate * 1024 * 1024
+
+    @staticmethod
+    def _weight(name):
+        return max(float(config['streamers'].get(name, {}).get('upload_priority', 1)), 0.01)
+
+    def _head(self):
+        return min(self._waiting, key=lambda t: (self._vtime[self._waiting[t]], t), default=None)
+
+    def _notify(self):
+        # 调用时需持有 _lock 唤醒排在最前面的任务，在它自己的事件循环中重新申请
+        future = self._sleeping.pop(self._head(), None)
+        if future is not None:
+            future.get_loop().call_soon_threadsafe(_set_result, future)
+
+    def _grant(self, ticket, name, size):
+        # 调用时需持有 _lock
+        limit = config.get('upload_chunks', 0)
+        if limit and self._in_flight >= limit:
+            return None
+        if self._head() != ticket:
+            return None
+        del self._waiting[ticket]
+        self._in_flight += 1
+        self._clock = self._vtime[name]
+        self._vtime[name] += size / self._weight(name)
+        rate = self._rate()
+        if rate != self._bucket.rate:
+            # 录制开始或结束时调整限速 保留已透支的令牌
+            self._bucket.rate = rate
+            self._bucket.capacity = max(rate, 1)
+        # 下一个任务可能也有空闲的分片额度
+        self._notify()
+        return self._bucket.reserve(size)
+
+    async def acquire(self, name, size):
+        """申请上传 size 字节的分片，使用完毕后需调用 release"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            ticket = next(self._counter)
+            if name not in self._waiting.values():
+                # 新加入的主播从当前进度开始计算，不能因为之前空闲而占用过多额度
+                self._vtime[name] = max(self._vtime.get(name, 0.), self._clock)
+            self._waiting[ticket] = name
+        try:
+            while True:
+                with self._lock:
+                    wait = self._grant(ticket, name, size)
+                    if wait is None:
+                        future = self._sleeping[ticket] = loop.create_future()
+                if wait is not None:
+                    break
+                # 由 release 或前一个任务获得额度时唤醒
+                await asyncio.wait((future,), timeout=self.recheck_interval)
+        except BaseException:
+            with self._lock:
+                self._sleeping.pop(ticket, None)
+                if self._waiting.pop(ticket, None) is not None:
+                    self._notify()
+            raise
+        finally:
+            with self._lock:
+                self._sleeping.pop(ticket, None)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                self.release()
+                raise
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._notify()
+
+
+def _set_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+upload_scheduler = UploadScheduler()
+
+
+class UploadSweep(Timer):
+    """
+    上传由录制结束触发，这里每隔 upload_sweep_interval 秒(默认300)检查一次索引中遗留的录播，
+    如启动前未上传完成的文件或上传失败后留下的文件，只为有待上传文件且空闲的主播发送上传事件
+    """
+
+    def __init__(self, context):
+        super().__init__(interval=config.get('upload_sweep_interval', 300))
+        self.context = context
+
+    def pending(self):
+        """有待上传文件 且没有正在录制或上传的主播"""
+        context = self.context
+        uploading = {os.path.splitext(name)[0] for name in context['upload_filename']}
+        result = []
+        for name, streamer in list(config['streamers'].items()):
+            urls = streamer['url']
+            if any(context['url_status'].get(url) == 1 or context['url_upload_count'].get(url, 0) > 0
+                   for url in urls):
+                continue
+            files = [file for file in catalog.files(name)
+                     if os.path.splitext(file)[1] in media_extensions
+                     and os.path.splitext(file)[0] not in uploading]
+            if files:
+                result.append((name, urls[0]))
+        return result
+
+    async def atimer(self):
+        from biliup.downloader import send_upload_event
+        self.interval = config.get('upload_sweep_interval', 300)
+        loop = asyncio.get_running_loop()
+        try:
+            pending = await loop.run_in_executor(None, self.pending)
+        except Exception:
+            logger.exception('检查待上传文件失败')
+            return
+        for name, url in pending:
+            logger.info(f'{name} 有未上传的录播')
+            # 队列已满时会阻塞 不能占用检测调度所在的事件循环
+            await loop.run_in_executor(None, partial(
+                send_upload_event, {'name': name, 'url': url}, coalesce=True))
@@ -4,16 +4,17 @@ import subprocess
 import time
 import json
 
-from . import plugins
 from .common.tools import NamedLock
 from .downloader import download, send_upload_event
 from .engine import invert_dict, Plugin
 from biliup.config import config
+from .common.metrics import metrics
 from .engine.event import EventManager
-from .uploader import upload
+from .uploader import upload, upload_segment
 
 DOWNLOAD = 'download'
 UPLOAD = 'upload'
+SEGMENT = 'segment'
 logger = logging.getLogger('biliup')
 
 
@@ -24,21 +25,81 @@ def create_event_manager():
     pool1_size = config.get('pool1_size', 3)
     pool2_size = config.get('pool2_size', 3)
     # 初始化事件管理器
-    app = EventManager(config, pool1_size=pool1_size, pool2_size=pool2_size)
+    app = EventManager(config, pool1_size=pool1_size, pool2_size=pool2_size,
+                       maxsize=config.get('event_queue_size', 1024))
+    # 开播后尽快开始录制 下载事件不排在上传事件之后
+    app.set_priority(DOWNLOAD, 1)
     app.context['urls'] = urls
     app.context['url_status'] = dict.fromkeys(inverted_index, 0)
     app.context['url_upload_count'] = dict.fromkeys(inverted_index, 0)
     # 正在上传的文件 用于同时上传一个url的时候过滤掉正在上传的
     app.context['upload_filename'] = []
-    app.context['checker'] = Plugin(plugins).sorted_checker(urls)
+    app.context['checker'] = Plugin.sorted_checker(urls)
     app.context['inverted_index'] = inverted_index
     app.context['streamer_url'] = streamer_url
+    metrics.gauge('biliup_event_queue_depth', '等待分发的事件数', ('type',),
+                  function=lambda: {(k,): v for k, v in app.queue_depth().items()})
+    metrics.gauge('biliup_pool_active_tasks', '线程池中正在执行的任务数', ('pool',),
+                  function=lambda: {(k,): v[0] for k, v in app.pool_usage().items()})
+    metrics.gauge('biliup_pool_pending_tasks', '线程池中等待执行的任务数', ('pool',),
+                  function=lambda: {(k,): v[1] for k, v in app.pool_usage().items()})
+    metrics.gauge('biliup_pool_threads', '线程池大小', ('pool',),
+                  function=lambda: {(k,): v[2] for k, v in app.pool_usage().items()})
     return app
 
 
 event_manager = create_event_manager()
 
 
+def reload_streamers():
+    """
+    按 config['streamers'] 更新运行中的检测与录制状态，无需重启进程
+    新增的url开始检测；删除的url停止检测，正在录制或上传的url在结束后才移除状态；
+    正在进行的录制和上传继续使用开始时的配置
+    """
+    context = event_manager.context
+    with NamedLock('reload_streamers'):
+        streamer_url = {k: v['url'] for k, v in config['streamers'].items()}
+        inverted_index = invert_dict(streamer_url)
+        urls = list(inverted_index.keys())
+        # KernelFunc 与检测调度器持有这些对象的引用 需要原地修改
+        context['urls'][:] = urls
+        url_status = context['url_status']
+        url_upload_count = context['url_upload_count']
+        for url in urls:
+            url_status.setdefault(url, 0)
+            with NamedLock(f"upload_count_{url}"):
+                url_upload_count.setdefault(url, 0)
+        for url in list(url_status):
+            if url not in inverted_index and url_status[url] == 0 and url_upload_count.get(url, 0) == 0:
+                del url_status[url]
+                url_upload_count.pop(url, None)
+        # 已删除但仍在录制的url 保留主播名以便结束后上传
+        for url, name in context['inverted_index'].items():
+            if url not in inverted_index and url in url_status:
+                inverted_index[url] = name
+        _update_in_place(context['inverted_index'], inverted_index)
+        _update_in_place(context['streamer_url'], streamer_url)
+        checker = Plugin.sorted_checker(urls)
+        for plugin in context['checker'].values():
+            if plugin not in checker.values():
+                plugin.url_list = []
+        _update_in_place(context['checker'], checker)
+    scheduler = context.get('scheduler')
+    if scheduler is not None:
+        scheduler.reload()
+    logger.info(f'已加载 {len(config["streamers"])} 个主播的配置')
+
+
+def _update_in_place(target, source):
+    """其他线程可能正在读取 target 不先清空 只删除移除的键并写入新增或变化的值"""
+    for key in [key for key in target if key not in source]:
+        del target[key]
+    for key, value in source.items():
+        if key not in target or target[key] != value:
+            target[key] = value
+
+
 @event_manager.register(DOWNLOAD, block='Asynchronous1')
 def process(name, url):
     stream_info = {
@@ -54,6 +115,8 @@ def process(name, url):
         }, ensure_ascii=False))
 
     url_status = event_manager.context['url_status']
+    # 录制过程中主播被移出配置时 结束后仍按原配置上传
+    streamer_config = config['streamers'].get(name, {})
     # 下载开始
     try:
         kwargs: dict = config['streamers'][name].copy()
@@ -67,6 +130,7 @@ def process(name, url):
     finally:
         # 下载结束
         # 永远不可能有两个同url的下载线程
+        stream_info['streamer_config'] = streamer_config
         send_upload_event(stream_info)
         url_status[url] = 0
 
@@ -83,7 +147,20 @@ def process_upload(stream_info):
     finally:
         # 上传结束
         # 有可能有两个同url的上传线程 保证计数正确
-        with NamedLock(f'upload_count_{stream_info.url}'):
+        with NamedLock(f"upload_count_{stream_info['url']}"):
+            url_upload_count[url] -= 1
+
+
+@event_manager.register(SEGMENT, block='Asynchronous2')
+def process_segment(stream_info, filename):
+    url = stream_info['url']
+    url_upload_count = event_manager.context['url_upload_count']
+    try:
+        upload_segment(stream_info, filename)
+    except Exception as e:
+        logger.exception(f"分段上传错误: {stream_info['name']} - {e}")
+    finally:
+        with NamedLock(f"upload_count_{url}"):
             url_upload_count[url] -= 1
 
 
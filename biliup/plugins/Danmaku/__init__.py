@@ -4,11 +4,10 @@
 # 仅抓取用户弹幕，不包括入场提醒、礼物赠送等。
 
 import asyncio
+import importlib
 import os
-import platform
 import re
 import ssl
-import sys
 import threading
 import time
 import logging
@@ -17,14 +16,22 @@ from typing import Optional, List
 import lxml.etree as etree
 import aiohttp
 
-from biliup.plugins.Danmaku.douyu import Douyu
-from biliup.plugins.Danmaku.huya import Huya
-from biliup.plugins.Danmaku.bilibili import Bilibili
-from biliup.plugins.Danmaku.twitch import Twitch
-from biliup.plugins.Danmaku.douyin import Douyin
+from biliup.common.tools import LoopThread
+from biliup.engine.decorators import UrlRouter
 
 logger = logging.getLogger('biliup')
 
+# {域名: (模块名, 类名)} 录制弹幕时才导入对应平台的模块
+danmaku_sites = {
+    'douyu.com': ('douyu', 'Douyu'),
+    'huya.com': ('huya', 'Huya'),
+    'live.bilibili.com': ('bilibili', 'Bilibili'),
+    'twitch.tv': ('twitch', 'Twitch'),
+    'douyin.com': ('douyin', 'Douyin'),
+}
+danmaku_router = UrlRouter(
+    (r'^(?:http[s]?://)?.*?%s/(.+?)$' % re.escape(u), (u, *site)) for u, site in danmaku_sites.items())
+
 
 class DanmakuClient:
     class WebsocketErrorException(Exception):
@@ -40,21 +47,17 @@ class DanmakuClient:
         self.__ws = None
         self.__dm_queue = None
         self.__record_task: Optional[asyncio.Task] = None
+        self.__writer: Optional[DanmakuWriter] = None
+        self.__stopped = threading.Event()
 
         if 'http://' == url[:7] or 'https://' == url[:8]:
             self.__url = url
         else:
             self.__url = 'http://' + url
-        for u, s in {'douyu.com': Douyu,
-                     'huya.com': Huya,
-                     'live.bilibili.com': Bilibili,
-                     'twitch.tv': Twitch,
-                     'douyin.com': Douyin
-                     }.items():
-            if re.match(r'^(?:http[s]?://)?.*?%s/(.+?)$' % u, url):
-                self.__site = s
-                self.__u = u
-                break
+        site, _ = danmaku_router.match(url)
+        if site is not None:
+            self.__u, module, name = site
+            self.__site = getattr(importlib.import_module(f'{__name__}.{module}'), name)
 
         if self.__site is None:
             # 抛出异常由外部处理 exit()会导致进程退出
@@ -121,79 +124,68 @@ class DanmakuClient:
                 # 这里出现异常只会是 decode_msg 的问题
 
     async def __print_danmaku(self):
-        parser = etree.XMLParser(recover=True)
-        root = etree.Element("root")
-        tree = etree.ElementTree(root, parser=parser)
-        msg_i = 0
         msg_col = {'0': '16777215', '1': '16717077', '2': '2000880', '3': '8046667', '4': '16744192',
                    '5': '10172916',
                    '6': '16738740'}
 
-        def write_file(filename):
+        while True:
             try:
-                with open(filename, "wb") as f:
-                    etree.indent(root, "\t")
-                    tree.write(f, encoding="UTF-8", xml_declaration=True, pretty_print=True)
-            except Exception as e:
-                logger.warning(f"{DanmakuClient.__name__}:{self.__url}: 弹幕写入异常 - {e}")
+                m = await asyncio.wait_for(self.__dm_queue.get(), self.__writer.flush_interval)
+            except asyncio.TimeoutError:
+                # 一段时间没有新弹幕 把缓冲中的弹幕写入文件
+                self.__writer.flush()
+                continue
+            if m.get('msg_type') == 'danmaku':
+                try:
+                    d = etree.Element('d')
+                    if 'col' in m:
+                        color = msg_col[m["col"]]
+                    elif 'color' in m:
+                        color = m["color"]
+                    else:
+                        color = '16777215'
+                    msg_time = format(time.time() - self.__starttime, '.3f')
+                    d.set('p', f"{msg_time},1,25,{color},0,0,0,0")
+                    d.text = m["content"]
+                except Exception as Error:
+                    logger.warning(f"{DanmakuClient.__name__}:{self.__url}:弹幕处理异常 - {Error}")
+                    # 异常后略过本次弹幕
+                    continue
+                self.__writer.write(d)
 
+    def start(self):
+        async def __create():
+            task = asyncio.create_task(self.__record())
+            task.add_done_callback(lambda _: self.__stopped.set())
+            return task
+
+        self.__stopped.clear()
+        # 在弹幕事件循环中创建录制任务 返回后即可安全地停止任务
+        self.__record_task = DanmakuHub.submit(__create()).result()
+
+    async def __record(self):
+        logger.info(f'开始弹幕录制: {self.__filename}')
+        self.__writer = DanmakuWriter(self.__filename)
         try:
-            while True:
-                m = await self.__dm_queue.get()
-                if m.get('msg_type') == 'danmaku':
-                    try:
-                        d = etree.SubElement(root, 'd')
-                        if 'col' in m:
-                            color = msg_col[m["col"]]
-                        elif 'color' in m:
-                            color = m["color"]
-                        else:
-                            color = '16777215'
-                        msg_time = format(time.time() - self.__starttime, '.3f')
-                        d.set('p', f"{msg_time},1,25,{color},0,0,0,0")
-                        d.text = m["content"]
-                    except Exception as Error:
-                        logger.warning(f"{DanmakuClient.__name__}:{self.__url}:弹幕处理异常 - {Error}")
-                        # 异常后略过本次弹幕
-                        continue
-
-                    if msg_i >= 5:
-                        # 收到五条弹幕后写入 减少io
-                        # 可能会写入失败 会在下次五条或者任务被取消时重新尝试写入
-                        write_file(self.__filename)
-                        msg_i = 0
-                    else:
-                        msg_i = msg_i + 1
+            self.__writer.open()
+        except Exception as e:
+            logger.warning(f"{DanmakuClient.__name__}:{self.__url}: 弹幕文件创建异常 - {e}")
+            return
+        try:
+            await self.__run()
         except asyncio.CancelledError:
-            # 在这段代码中只有执行m = await self.__dm_queue.get()的时候可能会被取消 所以无需担心其他问题
-            # 任务被取消之前需要写入一下 不然会丢失没写入的
-            write_file(self.__filename)
+            pass
+        finally:
+            # 任务结束时写入缓冲中的弹幕以及结尾标签
+            self.__writer.close()
             # 如果不存在对应的视频则删除弹幕
             if not (os.path.exists(f"{self.__filename_video_suffix}.part") or
                     os.path.exists(f"{self.__filename_video_suffix}")):
-                os.remove(self.__filename)
-            raise
-
-    def start(self):
-        init_event = threading.Event()
-
-        async def __init():
-            logger.info(f'开始弹幕录制: {self.__filename}')
-            self.__record_task = asyncio.create_task(self.__run())
-            init_event.set()
-            try:
-                await self.__record_task
-            except asyncio.CancelledError:
-                pass
-            finally:
-                # fix event loop is close
-                if sys.version_info < (3, 11) and platform.system() == 'Windows':
-                    await asyncio.sleep(2)
-            logger.info(f'结束弹幕录制: {self.__filename}')
-
-        threading.Thread(target=asyncio.run, args=(__init(),)).start()
-        # 等待初始化完成避免未初始化完成的时候就停止任务
-        init_event.wait()
+                try:
+                    os.remove(self.__filename)
+                except FileNotFoundError:
+                    pass
+        logger.info(f'结束弹幕录制: {self.__filename}')
 
     async def __run(self):
         while True:
@@ -201,7 +193,7 @@ class DanmakuClient:
             danmaku_tasks: Optional[List[asyncio.Task]] = None
             try:
                 self.__dm_queue = asyncio.Queue()
-                self.__hs = aiohttp.ClientSession()
+                self.__hs = DanmakuHub.session()
                 await self.__init_ws()
                 danmaku_tasks = [asyncio.create_task(self.__heartbeats()),
                                  asyncio.create_task(self.__fetch_danmaku()),
@@ -224,16 +216,101 @@ class DanmakuClient:
                         task.cancel()
                 if self.__ws is not None and not self.__ws.closed:
                     await self.__ws.close()
-                if self.__hs is not None and not self.__hs.closed:
-                    await self.__hs.close()
                 if is_retry:
                     await asyncio.sleep(30)
                     continue
             break
 
-    def stop(self):
+    def stop(self, timeout=10):
         if self.__record_task is not None:
-            self.__record_task.cancel()
+            DanmakuHub.call_soon(self.__record_task.cancel)
+            # 等待弹幕写入完成 避免上传时弹幕文件还未关闭
+            self.__stopped.wait(timeout)
+
+
+class DanmakuHub:
+    """
+    进程内所有弹幕录制共用的事件循环线程与连接池
+    下载线程通过 DanmakuClient.start/stop 线程安全地提交和取消录制任务
+    """
+    loop_thread = LoopThread('DanmakuHub')
+    _session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def submit(cls, coro):
+        return cls.loop_thread.submit(coro)
+
+    @classmethod
+    def call_soon(cls, callback, *args):
+        cls.loop_thread.call_soon(callback, *args)
+
+    @classmethod
+    def session(cls) -> aiohttp.ClientSession:
+        # 只能在弹幕事件循环中调用 websocket会长期占用连接 所以不限制连接数
+        if cls._session is None or cls._session.closed:
+            cls._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        return cls._session
+
+
+class DanmakuWriter:
+    """
+    追加写入的弹幕xml，内存中只保留尚未落盘的弹幕。
+    每次落盘都从上次的结尾标签处覆盖写入，再补上</root>，
+    所以文件在任意时刻都是完整的xml，进程崩溃最多丢失最后一个缓冲周期的弹幕。
+    """
+    header = b"<?xml version='1.0' encoding='UTF-8'?>\n<root>\n"
+    footer = b'</root>\n'
+
+    def __init__(self, filename, flush_interval=5, flush_size=64 * 1024):
+        self.filename = filename
+        # 距离上次落盘超过flush_interval秒或者缓冲超过flush_size字节时写入文件
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._file = None
+        self._tail = 0
+        self._buffer = []
+        self._buffer_size = 0
+        self._last_flush = time.monotonic()
+
+    def open(self):
+        self._file = open(self.filename, 'wb')
+        self._file.write(self.header)
+        self._tail = self._file.tell()
+        self._file.write(self.footer)
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def write(self, element):
+        record = b'\t' + etree.tostring(element, encoding='UTF-8') + b'\n'
+        self._buffer.append(record)
+        self._buffer_size += len(record)
+        if self._buffer_size >= self.flush_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer or self._file is None:
+            return
+        try:
+            self._file.seek(self._tail)
+            self._file.write(b''.join(self._buffer))
+            self._tail = self._file.tell()
+            self._file.write(self.footer)
+            self._file.flush()
+        except Exception as e:
+            # 写入失败时保留缓冲 下次落盘时从结尾标签处重新写入
+            logger.warning(f"{DanmakuClient.__name__}:{self.filename}: 弹幕写入异常 - {e}")
+            return
+        self._buffer.clear()
+        self._buffer_size = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+
 
 # 虎牙直播：https://www.huya.com/lpl
 # 斗鱼直播：https://www.douyu.com/9999
@@ -3,6 +3,37 @@ import re
 
 logger = logging.getLogger('biliup')
 
+# 插件清单 启动时按配置中的url与上传平台只导入用到的插件模块
+# 新增插件时需要在此登记，与模块中 Plugin.download 的正则保持一致，按匹配优先级排列
+# {模块名: (下载插件url正则, ...)}
+download_manifest = {
+    'acfun': (r'(?:https?://)?(?:(?:www|m|live)\.)?acfun\.cn',),
+    'afreecaTV': (r"https?://(.*?)\.afreecatv\.com/(?P<username>\w+)(?:/\d+)?",),
+    'bilibili': (r'(?:https?://)?(?:(?:www|m|live)\.)?bilibili\.com',),
+    'cc': (r'(?:https?://)?cc\.163\.com',),
+    'douyin': (r'(?:https?://)?(?:(?:www|m|live)\.)?douyin\.com',),
+    'douyu': (r'(?:https?://)?(?:(?:www|m)\.)?douyu\.com',),
+    'egame': (r'(?:https?://)?(?:egame\.)?qq\.com',),
+    'huya': (r'(?:https?://)?(?:(?:www|m)\.)?huya\.com',),
+    'inke': (r'(?:https?://)?(?:(?:www)\.)?inke\.cn',),
+    'kuaishou': (r'(?:https?://)?(?:(?:(?:livev)\.(?:m))\.)?chenzhongtech\.com',
+                 r'(?:https?://)?(?:(?:live|www|v)\.)?(kuaishou)\.com'),
+    'missevan': (r'(?:https?://)?(?:(?:www|fm)\.)?missevan\.com',),
+    'nico': (r'(?:https?://)?(?:(?:www|m|live)\.)?nicovideo\.jp',),
+    'now': (r'(?:https?://)?(?:now\.)?qq\.com',),
+    'twitch': (r'https?://(?:(?:www|go|m)\.)?twitch\.tv/(?P<id>[^/]+)/(?:videos|profile|clips)',
+               r'(?:https?://)?(?:(?:www|go|m)\.)?twitch\.tv/(?P<id>[0-9_a-zA-Z]+)'),
+    'youtube': (r'https?://(?:(?:www|m)\.)?youtube\.com/(?P<id>.*?)\??(.*?)',),
+    'yy': (r'(?:https?://)?(?:(?:www)\.)yy\.com',),
+}
+# {上传平台: 模块名}
+upload_manifest = {
+    'bilibili': 'bili_chromeup',
+    'bili_web': 'bili_webup',
+    'biliup-rs': 'biliuprs',
+    'Noop': 'noop_uploader',
+}
+
 def match1(text, *patterns):
     if len(patterns) == 1:
         pattern = patterns[0]
@@ -1,13 +1,17 @@
 import asyncio
 import base64
+import functools
 import hashlib
 import json
 import math
 import os
 import re
+import statistics
 import sys
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict, dataclass, field, InitVar
 from json import JSONDecodeError
 from os.path import splitext, basename
@@ -22,15 +26,23 @@ import xml.etree.ElementTree as ET
 from requests.adapters import HTTPAdapter, Retry
 
 from biliup.config import config
+from ..common.metrics import metrics
 from ..engine import Plugin
-from ..engine.upload import UploadBase, logger
+from ..common.tools import NamedLock
+from ..engine.upload import UploadBase, logger, upload_scheduler
+
+chunk_seconds = metrics.histogram('biliup_upload_chunk_seconds', '上传单个分片的耗时', ('line',))
+chunk_retries = metrics.counter('biliup_upload_chunk_retries_total', '分片上传失败重试次数', ('line',))
+uploaded_bytes = metrics.counter('biliup_uploaded_bytes_total', '上传完成的字节数', ('line',))
+upload_speed = metrics.gauge('biliup_upload_speed', '最近一个文件的平均上传速度(字节/秒)', ('line',))
 
 
 @Plugin.upload(platform="bili_web")
 class BiliWeb(UploadBase):
     def __init__(
             self, principal, data, user, submit_api=None, copyright=2, postprocessor=None, dtime=None,
-            dynamic='', lines='AUTO', threads=3, tid=122, tags=None, cover_path=None, description='', credits=[]
+            dynamic='', lines='AUTO', threads=3, threads_max=None, tid=122, tags=None, cover_path=None,
+            description='', credits=[]
     ):
         super().__init__(principal, data, persistence_path='bili.cookie', postprocessor=postprocessor)
         if tags is None:
@@ -39,6 +51,7 @@ class BiliWeb(UploadBase):
         self.lines = lines
         self.submit_api = submit_api
         self.threads = threads
+        self.threads_max = threads_max
         self.tid = tid
         self.tags = tags
         self.cover_path = cover_path
@@ -55,8 +68,10 @@ class BiliWeb(UploadBase):
             bili.app_key = self.user.get('app_key')
             bili.appsec = self.user.get('appsec')
             bili.login(self.persistence_path, self.user)
-            for file in file_list:
-                video_part = bili.upload_file(file.video, self.lines, self.threads)  # 上传视频
+            # 上传视频
+            video_parts = bili.upload_files([file.video for file in file_list], self.lines, self.threads,
+                                            self.threads_max, principal=self.principal)
+            for video_part in video_parts:
                 video_part['title'] = video_part['title'][:80]
                 video.append(video_part)  # 添加已经上传的视频
             video.title = self.data["format_title"][:80]  # 稿件标题限制80字
@@ -81,8 +96,18 @@ class BiliWeb(UploadBase):
                 video.cover = bili.cover_up(self.cover_path).replace('http:', '')
             ret = bili.submit(self.submit_api)  # 提交视频
         logger.info(f"上传成功: {ret}")
+        for file in file_list:
+            UploadJournal.discard(file.video)
         return file_list
 
+    def upload_segment(self, file):
+        # 上传结果保存在续传记录中 提交时直接使用
+        with BiliBili(Data()) as bili:
+            bili.app_key = self.user.get('app_key')
+            bili.appsec = self.user.get('appsec')
+            bili.login(self.persistence_path, self.user)
+            bili.upload_files([file], self.lines, self.threads, self.threads_max, principal=self.principal)
+
     def creditsToDesc_v2(self):
             desc_v2 = []
             desc_v2_tmp = self.desc
@@ -132,6 +157,8 @@ class BiliBili:
         self.account = None
         self.__bili_jct = None
         self._auto_os = None
+        # _auto_os 是否来自自动测速
+        self._probed = False
         self.persistence_path = 'engine/bili.cookie'
 
     def check_tag(self, tag):
@@ -305,30 +332,37 @@ class BiliBili:
         if r and r["code"] == 0:
             return r['data']['hash'], rsa.PublicKey.load_pkcs1_openssl_pem(r['data']['key'].encode())
 
-    def probe(self):
-        ret = self.__session.get('https://member.bilibili.com/preupload?r=probe', timeout=5).json()
-        logger.info(f"线路:{ret['lines']}")
-        data, auto_os = None, None
-        min_cost = 0
-        if ret['probe'].get('get'):
-            method = 'get'
-        else:
-            method = 'post'
-            data = bytes(int(1024 * 0.1 * 1024))
-        for line in ret['lines']:
-            start = time.perf_counter()
-            test = self.__session.request(method, f"https:{line['probe_url']}", data=data, timeout=30)
-            cost = time.perf_counter() - start
-            print(line['query'], cost)
-            if test.status_code != 200:
-                return
-            if not min_cost or min_cost > cost:
-                auto_os = line
-                min_cost = cost
-        auto_os['cost'] = min_cost
-        return auto_os
+    @staticmethod
+    def probe():
+        return LineProbe.best()
+
+    def upload_files(self, filepaths, lines='AUTO', tasks=3, tasks_max=None, principal=None):
+        """
+        在同一个事件循环中流水线上传多个文件，按传入顺序返回视频信息
+        最多 upload_pipeline 个文件同时上传，前一个文件合并分片时下一个文件已经开始上传分片，
+        所有文件同时上传的分片总数不超过 tasks_max
+        """
+        return asyncio.run(self._upload_files(filepaths, lines, tasks, tasks_max, principal))
+
+    async def _upload_files(self, filepaths, lines, tasks, tasks_max, principal):
+        pipeline = asyncio.Semaphore(max(int(config.get('upload_pipeline', 2)), 1))
+        budget = asyncio.Semaphore(max(int(tasks_max or tasks * 2), int(tasks), 1))
 
-    def upload_file(self, filepath: str, lines='AUTO', tasks=3):
+        async def upload(filepath):
+            async with pipeline:
+                return await self.aupload_file(filepath, lines, tasks, tasks_max, budget=budget, principal=principal)
+
+        return await asyncio.gather(*[upload(filepath) for filepath in filepaths])
+
+    async def _request(self, method, url, **kwargs):
+        """在线程池中执行阻塞的请求，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.__session.request, method, url, **kwargs))
+
+    def upload_file(self, filepath: str, lines='AUTO', tasks=3, tasks_max=None):
+        return asyncio.run(self.aupload_file(filepath, lines, tasks, tasks_max))
+
+    async def aupload_file(self, filepath: str, lines='AUTO', tasks=3, tasks_max=None, budget=None, principal=None):
         """上传本地视频文件,返回视频信息dict
         b站目前支持4种上传线路upos, kodo, gcs, bos
         gcs: {"os":"gcs","query":"bucket=bvcupcdngcsus&probe_version=20221109",
@@ -336,31 +370,86 @@ class BiliBili:
         bos: {"os":"bos","query":"bucket=bvcupcdnboshb&probe_version=20221109",
         "probe_url":"??"}
         """
-        preferred_upos_cdn = None
-        if not self._auto_os:
+        # 分段预先上传与提交前的上传可能同时进行 同一个文件只上传一次
+        lock = NamedLock(f'upload_file_{os.path.abspath(filepath)}')
+        acquire = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+        try:
+            await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            acquire.add_done_callback(lambda _: lock.release())
+            raise
+        try:
+            return await self._aupload_file(filepath, lines, tasks, tasks_max, budget, principal)
+        finally:
+            lock.release()
+
+    async def _aupload_file(self, filepath, lines, tasks, tasks_max, budget, principal):
+        journal = UploadJournal(filepath)
+        if journal.result is not None:
+            logger.info(f"{filepath} 已上传完成但未提交，跳过上传")
+            return journal.result
+        resumed = journal.head is not None
+        if resumed:
+            # 断点续传 沿用中断前的线路与上传凭证
+            auto_os = journal.head['auto_os']
+            ret = journal.head['ret']
+            logger.info(f"{filepath} 断点续传 => {auto_os['os']}: 已完成 {len(journal.parts)} 个分片")
+        else:
+            loop = asyncio.get_running_loop()
+            auto_os = await loop.run_in_executor(None, self.select_line, lines)
+            ret = await loop.run_in_executor(None, self.preupload, filepath, auto_os)
+            journal.begin(auto_os, ret)
+        if auto_os['os'] == 'upos':
+            upload = self.upos
+        elif auto_os['os'] == 'cos':
+            upload = self.cos
+        elif auto_os['os'] == 'cos-internal':
+            upload = lambda *args, **kwargs: self.cos(*args, **kwargs, internal=True)
+        elif auto_os['os'] == 'kodo':
+            upload = self.kodo
+        else:
+            logger.error(f"NoSearch:{auto_os['os']}")
+            raise NotImplementedError(auto_os['os'])
+        logger.info(f"os: {auto_os['os']}")
+        total_size = os.path.getsize(filepath)
+        # 并发数在 1 到 tasks_max 之间根据实测吞吐自动调整
+        concurrency = UploadConcurrency(tasks, tasks_max, budget=budget, principal=principal,
+                                        line='-'.join(filter(None, (auto_os['os'], auto_os.get('cdn')))))
+        with open(filepath, 'rb') as f:
+            result = None
+            try:
+                result = await upload(f, total_size, ret, tasks=concurrency, journal=journal)
+            finally:
+                LineProbe.report(auto_os, concurrency.speed, failed=result is None)
+                if result is None and resumed:
+                    # 续传仍然失败 上传凭证可能已失效 丢弃续传记录下次重新申请
+                    journal.remove()
+        if result is not None:
+            journal.complete(result)
+        return result
+
+    def select_line(self, lines='AUTO'):
+        # 自动测速的线路每个文件都从共享的测速结果中重新选择，使降级的线路能及时被替换，
+        # 测速失败时使用的默认线路没有测速结果，同样每次重新选择以便重新测速
+        if not self._auto_os or self._probed:
             if lines == 'kodo':
                 self._auto_os = {"os": "kodo", "query": "bucket=bvcupcdnkodobm&probe_version=20221109",
                                  "probe_url": "//up-na0.qbox.me/crossdomain.xml"}
             elif lines == 'bda2':
                 self._auto_os = {"os": "upos", "query": "upcdn=bda2&probe_version=20221109",
-                                 "probe_url": "//upos-sz-upcdnbda2.bilivideo.com/OK"}
-                preferred_upos_cdn = 'bda2'
+                                 "probe_url": "//upos-sz-upcdnbda2.bilivideo.com/OK", "cdn": "bda2"}
             elif lines == 'cs-bda2':
                 self._auto_os = {"os": "upos", "query": "upcdn=bda2&probe_version=20221109",
-                                 "probe_url": "//upos-cs-upcdnbda2.bilivideo.com/OK"}
-                preferred_upos_cdn = 'bda2'
+                                 "probe_url": "//upos-cs-upcdnbda2.bilivideo.com/OK", "cdn": "bda2"}
             elif lines == 'ws':
                 self._auto_os = {"os": "upos", "query": "upcdn=ws&probe_version=20221109",
-                                 "probe_url": "//upos-sz-upcdnws.bilivideo.com/OK"}
-                preferred_upos_cdn = 'ws'
+                                 "probe_url": "//upos-sz-upcdnws.bilivideo.com/OK", "cdn": "ws"}
             elif lines == 'qn':
                 self._auto_os = {"os": "upos", "query": "upcdn=qn&probe_version=20221109",
-                                 "probe_url": "//upos-sz-upcdnqn.bilivideo.com/OK"}
-                preferred_upos_cdn = 'qn'
+                                 "probe_url": "//upos-sz-upcdnqn.bilivideo.com/OK", "cdn": "qn"}
             elif lines == 'cs-qn':
                 self._auto_os = {"os": "upos", "query": "upcdn=qn&probe_version=20221109",
-                                 "probe_url": "//upos-cs-upcdnqn.bilivideo.com/OK"}
-                preferred_upos_cdn = 'qn'
+                                 "probe_url": "//upos-cs-upcdnqn.bilivideo.com/OK", "cdn": "qn"}
             elif lines == 'cos':
                 self._auto_os = {"os": "cos", "query": "",
                                  "probe_url": ""}
@@ -369,50 +458,42 @@ class BiliBili:
                                  "probe_url": ""}
             else:
                 self._auto_os = self.probe()
-            logger.info(f"线路选择 => {self._auto_os['os']}: {self._auto_os['query']}. time: {self._auto_os.get('cost')}")
-        if self._auto_os['os'] == 'upos':
-            upload = self.upos
-        elif self._auto_os['os'] == 'cos':
-            upload = self.cos
-        elif self._auto_os['os'] == 'cos-internal':
-            upload = lambda *args, **kwargs: self.cos(*args, **kwargs, internal=True)
-        elif self._auto_os['os'] == 'kodo':
-            upload = self.kodo
-        else:
-            logger.error(f"NoSearch:{self._auto_os['os']}")
-            raise NotImplementedError(self._auto_os['os'])
-        logger.info(f"os: {self._auto_os['os']}")
-        total_size = os.path.getsize(filepath)
-        with open(filepath, 'rb') as f:
-            query = {
-                'r': self._auto_os['os'] if self._auto_os['os'] != 'cos-internal' else 'cos',
-                'profile': 'ugcupos/bup' if 'upos' == self._auto_os['os'] else "ugcupos/bupfetch",
-                'ssl': 0,
-                'version': '2.8.12',
-                'build': 2081200,
-                'name': f.name,
-                'size': total_size,
-            }
-            resp = self.__session.get(
-                f"https://member.bilibili.com/preupload?{self._auto_os['query']}", params=query,
-                timeout=5)
-            ret = resp.json()
-            logger.debug(f"preupload: {ret}")
-            if preferred_upos_cdn:
-                original_endpoint: str = ret['endpoint']
-                if re.match(r'//upos-(sz|cs)-upcdn(bda2|ws|qn)\.bilivideo\.com', original_endpoint):
-                    if re.match(r'bda2|qn|ws', preferred_upos_cdn):
-                        logger.debug(f"Preferred UpOS CDN: {preferred_upos_cdn}")
-                        new_endpoint = re.sub(r'upcdn(bda2|qn|ws)', f'upcdn{preferred_upos_cdn}', original_endpoint)
-                        logger.debug(f"{original_endpoint} => {new_endpoint}")
-                        ret['endpoint'] = new_endpoint
-                    else:
-                        logger.error(f"Unrecognized preferred_upos_cdn: {preferred_upos_cdn}")
+                self._probed = True
+            logger.info(f"线路选择 => {self._auto_os['os']}: {self._auto_os['query']}. "
+                        f"speed: {self._auto_os.get('speed', 0) / 1000 / 1000:.2f}MB/s")
+        return self._auto_os
+
+    def preupload(self, filepath, auto_os):
+        preferred_upos_cdn = auto_os.get('cdn')
+        query = {
+            'r': auto_os['os'] if auto_os['os'] != 'cos-internal' else 'cos',
+            'profile': 'ugcupos/bup' if 'upos' == auto_os['os'] else "ugcupos/bupfetch",
+            'ssl': 0,
+            'version': '2.8.12',
+            'build': 2081200,
+            'name': basename(filepath),
+            'size': os.path.getsize(filepath),
+        }
+        resp = self.__session.get(
+            f"https://member.bilibili.com/preupload?{auto_os['query']}", params=query,
+            timeout=5)
+        ret = resp.json()
+        logger.debug(f"preupload: {ret}")
+        if preferred_upos_cdn:
+            original_endpoint: str = ret['endpoint']
+            if re.match(r'//upos-(sz|cs)-upcdn(bda2|ws|qn)\.bilivideo\.com', original_endpoint):
+                if re.match(r'bda2|qn|ws', preferred_upos_cdn):
+                    logger.debug(f"Preferred UpOS CDN: {preferred_upos_cdn}")
+                    new_endpoint = re.sub(r'upcdn(bda2|qn|ws)', f'upcdn{preferred_upos_cdn}', original_endpoint)
+                    logger.debug(f"{original_endpoint} => {new_endpoint}")
+                    ret['endpoint'] = new_endpoint
                 else:
-                    logger.warning(f"Assigned UpOS endpoint {original_endpoint} was never seen before, something else might have changed, so will not modify it")
-            return asyncio.run(upload(f, total_size, ret, tasks=tasks))
+                    logger.error(f"Unrecognized preferred_upos_cdn: {preferred_upos_cdn}")
+            else:
+                logger.warning(f"Assigned UpOS endpoint {original_endpoint} was never seen before, something else might have changed, so will not modify it")
+        return ret
 
-    async def cos(self, file, total_size, ret, chunk_size=10485760, tasks=3, internal=False):
+    async def cos(self, file, total_size, ret, chunk_size=None, tasks=3, internal=False, *, journal):
         filename = file.name
         url = ret["url"]
         if internal:
@@ -425,18 +506,27 @@ class BiliBili:
             "Authorization": ret["put_auth"],
         }
 
-        initiate_multipart_upload_result = ET.fromstring(self.__session.post(f'{url}?uploads&output=json', timeout=5,
-                                                                             headers=post_headers).content)
-        upload_id = initiate_multipart_upload_result.find('UploadId').text
+        upload_id = journal.head.get('upload_id')
+        if upload_id is None:
+            if chunk_size is None:
+                # cos 的分片大小由客户端决定 按以往实测速度选择
+                chunk_size = UploadConcurrency.chunk_size(total_size)
+            initiate_multipart_upload_result = ET.fromstring((await self._request(
+                'POST', f'{url}?uploads&output=json', timeout=5, headers=post_headers)).content)
+            upload_id = initiate_multipart_upload_result.find('UploadId').text
+            journal.update(upload_id=upload_id, chunk_size=chunk_size)
+        chunk_size = journal.head.get('chunk_size', chunk_size)
         # 开始上传
-        parts = []  # 分块信息
+        parts = [{"Part": part} for part in journal.parts.values()]  # 分块信息
         chunks = math.ceil(total_size / chunk_size)  # 获取分块数量
 
         async def upload_chunk(session, chunks_data, params):
             async with session.put(url, params=params, raise_for_status=True,
                                    data=chunks_data, headers=put_headers) as r:
                 end = time.perf_counter() - start
-                parts.append({"Part": {"PartNumber": params['chunk'] + 1, "ETag": r.headers['Etag']}})
+                part = {"PartNumber": params['chunk'] + 1, "ETag": r.headers['Etag']}
+                parts.append({"Part": part})
+                journal.add_part(params['chunk'], part)
                 sys.stdout.write(f"\r{params['end'] / 1000 / 1000 / end:.2f}MB/s "
                                  f"=> {params['partNumber'] / chunks:.1%}")
 
@@ -445,7 +535,7 @@ class BiliBili:
             'uploadId': upload_id,
             'chunks': chunks,
             'total': total_size
-        }, file, chunk_size, upload_chunk, tasks=tasks)
+        }, file, chunk_size, upload_chunk, tasks=tasks, skip=journal.parts)
         cost = time.perf_counter() - start
         fetch_headers = {
             "X-Upos-Fetch-Source": ret["fetch_headers"]["X-Upos-Fetch-Source"],
@@ -464,29 +554,30 @@ class BiliBili:
         ii = 0
         while ii <= 3:
             try:
-                res = self.__session.post(url, params={'uploadId': upload_id}, data=xml, headers=post_headers,
-                                          timeout=15)
+                res = await self._request('POST', url, params={'uploadId': upload_id}, data=xml,
+                                          headers=post_headers, timeout=15)
                 if res.status_code == 200:
                     break
                 raise IOError(res.text)
             except IOError:
                 ii += 1
                 logger.info("请求合并分片出现问题，尝试重连，次数：" + str(ii))
-                time.sleep(15)
+                await asyncio.sleep(15)
         ii = 0
         while ii <= 3:
             try:
-                res = self.__session.post("https:" + ret["fetch_url"], headers=fetch_headers, timeout=15).json()
+                res = (await self._request('POST', "https:" + ret["fetch_url"], headers=fetch_headers,
+                                           timeout=15)).json()
                 if res.get('OK') == 1:
                     logger.info(f'{filename} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s. {res}')
-                    return {"title": splitext(filename)[0], "filename": ret["bili_filename"], "desc": ""}
+                    return {"title": splitext(basename(filename))[0], "filename": ret["bili_filename"], "desc": ""}
                 raise IOError(res)
             except IOError:
                 ii += 1
                 logger.info("上传出现问题，尝试重连，次数：" + str(ii))
-                time.sleep(15)
+                await asyncio.sleep(15)
 
-    async def kodo(self, file, total_size, ret, chunk_size=4194304, tasks=3):
+    async def kodo(self, file, total_size, ret, chunk_size=4194304, tasks=3, *, journal):
         filename = file.name
         bili_filename = ret['bili_filename']
         key = ret['key']
@@ -499,7 +590,7 @@ class BiliBili:
             'Authorization': f"UpToken {token}",
         }
         # 开始上传
-        parts = []  # 分块信息
+        parts = list(journal.parts.values())  # 分块信息
         chunks = math.ceil(total_size / chunk_size)  # 获取分块数量
 
         async def upload_chunk(session, chunks_data, params):
@@ -507,24 +598,26 @@ class BiliBili:
                                     data=chunks_data, headers=headers) as response:
                 end = time.perf_counter() - start
                 ctx = await response.json()
-                parts.append({"index": params['chunk'], "ctx": ctx['ctx']})
+                part = {"index": params['chunk'], "ctx": ctx['ctx']}
+                parts.append(part)
+                journal.add_part(params['chunk'], part)
                 sys.stdout.write(f"\r{params['end'] / 1000 / 1000 / end:.2f}MB/s "
                                  f"=> {params['partNumber'] / chunks:.1%}")
 
         start = time.perf_counter()
-        await self._upload({}, file, chunk_size, upload_chunk, tasks=tasks)
+        await self._upload({}, file, chunk_size, upload_chunk, tasks=tasks, skip=journal.parts)
         cost = time.perf_counter() - start
 
         logger.info(f'{filename} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s')
         parts.sort(key=lambda x: x['index'])
-        self.__session.post(f"{endpoint}/mkfile/{total_size}/key/{base64.urlsafe_b64encode(key.encode()).decode()}",
+        await self._request('POST', f"{endpoint}/mkfile/{total_size}/key/{base64.urlsafe_b64encode(key.encode()).decode()}",
                             data=','.join(map(lambda x: x['ctx'], parts)), headers=headers, timeout=10)
-        r = self.__session.post(f"https:{fetch_url}", headers=fetch_headers, timeout=5).json()
+        r = (await self._request('POST', f"https:{fetch_url}", headers=fetch_headers, timeout=5)).json()
         if r["OK"] != 1:
             raise Exception(r)
-        return {"title": splitext(filename)[0], "filename": bili_filename, "desc": ""}
+        return {"title": splitext(basename(filename))[0], "filename": bili_filename, "desc": ""}
 
-    async def upos(self, file, total_size, ret, tasks=3):
+    async def upos(self, file, total_size, ret, tasks=3, *, journal):
         filename = file.name
         chunk_size = ret['chunk_size']
         auth = ret["auth"]
@@ -535,18 +628,23 @@ class BiliBili:
         headers = {
             "X-Upos-Auth": auth
         }
-        # 向上传地址申请上传，得到上传id等信息
-        upload_id = self.__session.post(f'{url}?uploads&output=json', timeout=15,
-                                        headers=headers).json()["upload_id"]
+        upload_id = journal.head.get('upload_id')
+        if upload_id is None:
+            # 向上传地址申请上传，得到上传id等信息
+            upload_id = (await self._request('POST', f'{url}?uploads&output=json', timeout=15,
+                                             headers=headers)).json()["upload_id"]
+            journal.update(upload_id=upload_id, chunk_size=chunk_size)
         # 开始上传
-        parts = []  # 分块信息
+        parts = list(journal.parts.values())  # 分块信息
         chunks = math.ceil(total_size / chunk_size)  # 获取分块数量
 
         async def upload_chunk(session, chunks_data, params):
             async with session.put(url, params=params, raise_for_status=True,
                                    data=chunks_data, headers=headers):
                 end = time.perf_counter() - start
-                parts.append({"partNumber": params['chunk'] + 1, "eTag": "etag"})
+                part = {"partNumber": params['chunk'] + 1, "eTag": "etag"}
+                parts.append(part)
+                journal.add_part(params['chunk'], part)
                 sys.stdout.write(f"\r{params['end'] / 1000 / 1000 / end:.2f}MB/s "
                                  f"=> {params['partNumber'] / chunks:.1%}")
 
@@ -555,7 +653,7 @@ class BiliBili:
             'uploadId': upload_id,
             'chunks': chunks,
             'total': total_size
-        }, file, chunk_size, upload_chunk, tasks=tasks)
+        }, file, chunk_size, upload_chunk, tasks=tasks, skip=journal.parts)
         cost = time.perf_counter() - start
         p = {
             'name': filename,
@@ -567,40 +665,78 @@ class BiliBili:
         attempt = 0
         while attempt <= 5:  # 一旦放弃就会丢失前面所有的进度，多试几次吧
             try:
-                r = self.__session.post(url, params=p, json={"parts": parts}, headers=headers, timeout=15).json()
+                parts.sort(key=lambda x: x['partNumber'])
+                r = (await self._request('POST', url, params=p, json={"parts": parts}, headers=headers,
+                                         timeout=15)).json()
                 if r.get('OK') == 1:
                     logger.info(f'{filename} uploaded >> {total_size / 1000 / 1000 / cost:.2f}MB/s. {r}')
-                    return {"title": splitext(filename)[0], "filename": splitext(basename(upos_uri))[0], "desc": ""}
+                    return {"title": splitext(basename(filename))[0], "filename": splitext(basename(upos_uri))[0], "desc": ""}
                 raise IOError(r)
             except IOError:
                 attempt += 1
                 logger.info(f"请求合并分片时出现问题，尝试重连，次数：" + str(attempt))
-                time.sleep(15)
+                await asyncio.sleep(15)
 
     @staticmethod
-    async def _upload(params, file, chunk_size, afunc, tasks=3):
-        params['chunk'] = -1
+    async def _upload(params, file, chunk_size, afunc, tasks=3, skip=()):
+        concurrency = tasks if isinstance(tasks, UploadConcurrency) else UploadConcurrency(tasks, tasks)
+        total_size = os.fstat(file.fileno()).st_size
+        # 跳过续传记录中已完成的分片
+        reader = ChunkReader(file, chunk_size,
+                             [i for i in range(math.ceil(total_size / chunk_size)) if i not in skip],
+                             tasks=concurrency.maximum)
 
         async def upload_chunk():
             while True:
-                chunks_data = file.read(chunk_size)
-                if not chunks_data:
+                await concurrency.acquire()
+                item = await reader.get()
+                if item is None:
+                    concurrency.release()
                     return
-                params['chunk'] += 1
-                params['size'] = len(chunks_data)
-                params['partNumber'] = params['chunk'] + 1
-                params['start'] = params['chunk'] * chunk_size
-                params['end'] = params['start'] + params['size']
+                index, chunks_data = item
                 clone = params.copy()
-                for i in range(10):
-                    try:
-                        await afunc(session, chunks_data, clone)
-                        break
-                    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-                        logger.error(f"retry chunk{clone['chunk']} >> {i + 1}. {e}")
+                clone['chunk'] = index
+                clone['size'] = len(chunks_data)
+                clone['partNumber'] = index + 1
+                clone['start'] = index * chunk_size
+                clone['end'] = clone['start'] + clone['size']
+                try:
+                    await upload_scheduler.acquire(concurrency.principal, clone['size'])
+                except BaseException:
+                    concurrency.release()
+                    reader.release(chunks_data)
+                    raise
+                try:
+                    for i in range(10):
+                        start = time.perf_counter()
+                        try:
+                            await afunc(session, chunks_data, clone)
+                            elapsed = time.perf_counter() - start
+                            concurrency.feedback(clone['size'], elapsed)
+                            chunk_seconds.observe(elapsed, line=concurrency.line)
+                            uploaded_bytes.inc(clone['size'], line=concurrency.line)
+                            break
+                        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                            concurrency.feedback(0, time.perf_counter() - start, failed=True)
+                            chunk_retries.inc(line=concurrency.line)
+                            logger.error(f"retry chunk{clone['chunk']} >> {i + 1}. {e}")
+                finally:
+                    upload_scheduler.release()
+                    concurrency.release()
+                    reader.release(chunks_data)
 
         async with aiohttp.ClientSession() as session:
-            await asyncio.gather(*[upload_chunk() for _ in range(tasks)])
+            producer = asyncio.ensure_future(reader.produce())
+            try:
+                await asyncio.gather(*[upload_chunk() for _ in range(concurrency.maximum)])
+            finally:
+                producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            if not producer.cancelled() and producer.exception():
+                raise producer.exception()
+        upload_speed.set(concurrency.speed, line=concurrency.line)
+        logger.info(f"{file.name} 分片大小: {chunk_size / 1024 / 1024:.1f}MB, 并发数: {concurrency}, "
+                    f"平均速度: {concurrency.speed / 1000 / 1000:.2f}MB/s")
 
     def submit(self, submit_api=None):
         if not self.video.title:
@@ -714,6 +850,374 @@ class BiliBili:
         self.__session.close()
 
 
+class LineProbe:
+    """
+    上传线路测速，结果在进程内所有上传任务间共享。
+    所有线路并发测速，每条线路采样多次，按吞吐量中位数排序。
+    结果超过 ttl 后先继续使用旧结果，同时在后台重新测速；上传失败或速度明显下降的线路会被降级。
+    """
+    ttl = 30 * 60
+    samples = 3
+    timeout = 5
+    payload = 512 * 1024
+    # 所有线路都不可用时使用的线路
+    fallback = {"os": "upos", "query": "upcdn=bda2&probe_version=20221109",
+                "probe_url": "//upos-sz-upcdnbda2.bilivideo.com/OK", "cdn": "bda2"}
+    _lock = threading.Lock()
+    _probe_lock = threading.Lock()
+    _ranked = []
+    _expires = 0.
+    # 被降级的线路 => 降级截止时间，期间重新测速也排在最后
+    _demoted = {}
+    _refreshing = False
+    _session = None
+
+    @classmethod
+    def best(cls):
+        with cls._lock:
+            ranked = cls._ranked
+            if ranked and time.monotonic() > cls._expires:
+                cls._refresh_in_background()
+        if not ranked:
+            # 首次测速 同时开始的上传任务等待同一次测速结果
+            with cls._probe_lock:
+                if not cls._ranked:
+                    cls.refresh()
+                ranked = cls._ranked
+        if not ranked:
+            logger.error(f"线路测速失败，使用默认线路 {cls.fallback['query']}")
+            return dict(cls.fallback)
+        return dict(ranked[0])
+
+    @classmethod
+    def report(cls, line, speed=None, failed=False):
+        """上传结束后反馈线路的实际表现"""
+        with cls._lock:
+            entry = next((l for l in cls._ranked if l['os'] == line['os'] and l['query'] == line['query']), None)
+            if entry is None:
+                return
+            previous = entry.get('upload_speed')
+            if speed:
+                entry['upload_speed'] = speed if previous is None else (previous + speed) / 2
+            if failed or (previous and speed and speed < previous / 2):
+                logger.info(f"线路 {entry['query']} 上传{'失败' if failed else '速度下降'}，降级并重新测速")
+                cls._ranked = [l for l in cls._ranked if l is not entry] + [entry]
+                cls._demoted[entry['query']] = time.monotonic() + cls.ttl
+                cls._refresh_in_background()
+
+    @classmethod
+    def refresh(cls):
+        if cls._session is None:
+            cls._session = requests.Session()
+            cls._session.headers.update({
+                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 Chrome/63.0.3239.108",
+                "Referer": "https://www.bilibili.com/",
+            })
+        try:
+            ret = cls._session.get('https://member.bilibili.com/preupload?r=probe', timeout=cls.timeout).json()
+        except (requests.exceptions.RequestException, JSONDecodeError) as e:
+            return logger.error(f"获取上传线路失败 {e}")
+        method = 'get' if ret['probe'].get('get') else 'post'
+        lines = ret['lines']
+        with ThreadPoolExecutor(max(len(lines), 1), thread_name_prefix='LineProbe') as executor:
+            speeds = list(executor.map(lambda l: cls._measure(method, l), lines))
+        now = time.monotonic()
+        ranked = []
+        for line, speed in sorted(zip(lines, speeds),
+                                  key=lambda x: (cls._demoted.get(x[0]['query'], 0) < now, x[1]), reverse=True):
+            if speed:
+                ranked.append({**line, 'speed': speed})
+        logger.info('线路测速: ' + ', '.join(f"{l['query']} {l['speed'] / 1000 / 1000:.2f}MB/s" for l in ranked))
+        with cls._lock:
+            cls._ranked = ranked
+            cls._expires = time.monotonic() + cls.ttl
+
+    @classmethod
+    def _measure(cls, method, line):
+        data = bytes(cls.payload) if method == 'post' else None
+        speeds = []
+        for _ in range(cls.samples):
+            start = time.perf_counter()
+            try:
+                r = cls._session.request(method, f"https:{line['probe_url']}", data=data, timeout=cls.timeout)
+            except requests.exceptions.RequestException:
+                continue
+            cost = time.perf_counter() - start
+            if r.status_code == 200:
+                speeds.append((len(data) if data else len(r.content)) / cost)
+        return statistics.median(speeds) if speeds else 0
+
+    @classmethod
+    def _refresh_in_background(cls):
+        # 调用时需持有 _lock
+        if cls._refreshing:
+            return
+        cls._refreshing = True
+        cls._expires = time.monotonic() + cls.ttl
+
+        def work():
+            try:
+                cls.refresh()
+            except:
+                logger.exception("LineProbe")
+            finally:
+                cls._refreshing = False
+
+        threading.Thread(target=work, name='LineProbe', daemon=True).start()
+
+
+class UploadConcurrency:
+    """
+    AIMD 方式调整单文件的分片并发数：每完成一轮(与当前并发数相同数量的分片)统计一次吞吐，
+    吞吐提升时并发数加一，提升不明显且分片延迟升高或吞吐下降时减一，分片失败重试时减半，
+    并发数限制在 1 到 maximum 之间。
+    """
+    # 进程内最近一次上传的单并发速度(字节/秒)，用于选择下一个文件的分片大小
+    last_speed = None
+
+    def __init__(self, tasks=3, tasks_max=None, budget=None, principal=None, line=''):
+        self.limit = max(int(tasks), 1)
+        # 用于全局上传调度中按主播分配带宽
+        self.principal = principal
+        # 上传线路 用于统计指标
+        self.line = line
+        # 多个文件同时上传时共享的分片并发额度
+        self.budget = budget
+        self.maximum = max(int(tasks_max or tasks * 2), self.limit)
+        self.in_flight = 0
+        self.peak = self.limit
+        self.total_bytes = 0
+        self.total_time = 0.
+        self._started = None
+        self._changed = None
+        self._window_bytes = 0
+        self._window_chunks = 0
+        self._window_latency = 0.
+        self._last_throughput = None
+        self._min_latency = None
+        self._cond = None
+
+    @classmethod
+    def chunk_size(cls, total_size, minimum=4 * 1024 * 1024, maximum=64 * 1024 * 1024, seconds=4, max_chunks=10000):
+        """按单并发速度使每个分片约耗时 seconds 秒，按MB取整"""
+        size = cls.last_speed * seconds if cls.last_speed else 10 * 1024 * 1024
+        size = max(minimum, min(size, maximum), math.ceil(total_size / max_chunks))
+        return math.ceil(size / 1024 / 1024) * 1024 * 1024
+
+    @property
+    def speed(self):
+        return self.total_bytes / self.total_time if self.total_time else 0
+
+    def __str__(self):
+        return f'{self.limit}(最高 {self.peak}, 上限 {self.maximum})'
+
+    async def acquire(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+            self._started = self._changed = time.perf_counter()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        if self.budget is not None:
+            await self.budget.acquire()
+
+    def release(self):
+        if self.budget is not None:
+            self.budget.release()
+        self.in_flight -= 1
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def feedback(self, size, latency, failed=False):
+        now = time.perf_counter()
+        if failed:
+            # 出现重试说明链路已经拥塞
+            self._set_limit(self.limit // 2, now)
+            return
+        self.total_bytes += size
+        self.total_time = now - self._started
+        # 每字节延迟 用于判断排队
+        per_byte = latency / size if size else latency
+        if self._min_latency is None or per_byte < self._min_latency:
+            self._min_latency = per_byte
+        self._window_bytes += size
+        self._window_chunks += 1
+        self._window_latency += per_byte
+        if self._window_chunks < self.limit:
+            return
+        throughput = self._window_bytes / (now - self._changed)
+        latency = self._window_latency / self._window_chunks
+        UploadConcurrency.last_speed = throughput / self.limit
+        if self._last_throughput is None or throughput > self._last_throughput * 1.05:
+            self._set_limit(self.limit + 1, now)
+        elif throughput < self._last_throughput * 0.9 or latency > self._min_latency * 3:
+            self._set_limit(self.limit - 1, now)
+        else:
+            self._reset(now)
+        self._last_throughput = throughput
+
+    def _set_limit(self, limit, now):
+        limit = max(1, min(limit, self.maximum))
+        if limit != self.limit:
+            logger.debug(f'上传并发数 {self.limit} => {limit}')
+            self.limit = limit
+            self.peak = max(self.peak, limit)
+            asyncio.ensure_future(self._notify())
+        self._reset(now)
+
+    def _reset(self, now):
+        self._changed = now
+        self._window_bytes = 0
+        self._window_chunks = 0
+        self._window_latency = 0.
+
+
+class ChunkReader:
+    """
+    分片读取器，在线程池中用 preadv 将分片按偏移读入复用的缓冲区，以 memoryview 交给 aiohttp，
+    不在事件循环中阻塞读盘，也不为每个分片分配新的 bytes。
+    预读队列有上限，缓冲区总数为 上传并发数 + 预读数，内存占用约为 (tasks + readahead) × chunk_size。
+    """
+
+    def __init__(self, file, chunk_size, indexes, tasks=3, readahead=2):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.indexes = list(indexes)
+        self.tasks = tasks
+        self._limit = max(min(tasks + readahead, len(self.indexes)), 1)
+        self._allocated = 0
+        self._free = asyncio.Queue()
+        # 预读数量由缓冲区总数限制
+        self._ready = asyncio.Queue()
+
+    def _read(self, buffer, offset):
+        if hasattr(os, 'preadv'):
+            return os.preadv(self.file.fileno(), [buffer], offset)
+        # Windows 等不支持 preadv 的平台，读取只在 produce 中顺序进行，seek 不会相互干扰
+        self.file.seek(offset)
+        return self.file.readinto(buffer)
+
+    async def _buffer(self):
+        if self._free.empty() and self._allocated < self._limit:
+            self._allocated += 1
+            return bytearray(self.chunk_size)
+        return await self._free.get()
+
+    async def produce(self):
+        loop = asyncio.get_running_loop()
+        try:
+            for index in self.indexes:
+                buffer = await self._buffer()
+                size = await loop.run_in_executor(None, self._read, buffer, index * self.chunk_size)
+                if not size:
+                    self._free.put_nowait(buffer)
+                    break
+                self._ready.put_nowait((index, memoryview(buffer)[:size]))
+        finally:
+            # 通知所有上传协程结束
+            for _ in range(self.tasks):
+                self._ready.put_nowait(None)
+
+    async def get(self):
+        return await self._ready.get()
+
+    def release(self, view):
+        """分片上传完成后归还缓冲区"""
+        self._free.put_nowait(view.obj)
+
+
+class UploadJournal:
+    """
+    分片上传的续传记录，保存在 cache/upload 下，每行一个json，只追加写入。
+    第一行记录文件大小、修改时间、线路以及preupload返回的上传凭证，
+    之后依次追加上传id、每个已完成的分片，最后追加合并完成后的上传结果。
+    进程中断后重新上传同一个文件时只上传缺失的分片，已上传完成但未提交的文件直接返回上传结果。
+    """
+    dirname = 'cache/upload'
+
+    def __init__(self, filepath):
+        st = os.stat(filepath)
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.path = self.journal_path(filepath)
+        self.head = None
+        self.parts = {}
+        self.result = None
+        self._load()
+
+    @classmethod
+    def journal_path(cls, filepath):
+        digest = hashlib.md5(os.path.abspath(filepath).encode()).hexdigest()[:8]
+        return os.path.join(cls.dirname, f'{basename(filepath)}.{digest}.journal')
+
+    @classmethod
+    def discard(cls, filepath):
+        try:
+            os.remove(cls.journal_path(filepath))
+        except FileNotFoundError:
+            pass
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except JSONDecodeError:
+                # 写入时中断的最后一行
+                break
+            if self.head is None:
+                if record.get('size') != self.size or record.get('mtime') != self.mtime:
+                    # 文件已经变化 续传记录作废
+                    logger.info(f'续传记录与文件不一致，重新上传 - {self.path}')
+                    return self.remove()
+                self.head = record
+            elif 'part' in record:
+                self.parts[record['part']] = record['info']
+            elif 'result' in record:
+                self.result = record['result']
+            else:
+                self.head.update(record)
+
+    def _append(self, record, mode='a'):
+        os.makedirs(self.dirname, exist_ok=True)
+        with open(self.path, mode, encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def begin(self, auto_os, ret):
+        self.head = {'size': self.size, 'mtime': self.mtime, 'auto_os': auto_os, 'ret': ret}
+        self.parts = {}
+        self.result = None
+        self._append(self.head, mode='w')
+
+    def update(self, **kwargs):
+        self.head.update(kwargs)
+        self._append(kwargs)
+
+    def add_part(self, index, info):
+        self.parts[index] = info
+        self._append({'part': index, 'info': info})
+
+    def complete(self, result):
+        self.result = result
+        self._append({'result': result})
+
+    def remove(self):
+        self.head = None
+        self.parts = {}
+        self.result = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
 @dataclass
 class Data:
     """
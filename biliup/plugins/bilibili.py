@@ -1,5 +1,7 @@
 import re
 import time
+from typing import Generator, List
+
 import requests
 
 from biliup.config import config
@@ -8,6 +10,13 @@ from biliup.plugins.Danmaku import DanmakuClient
 from ..engine.decorators import Plugin
 from ..engine.download import DownloadBase
 
+# 批量检测时每次请求的直播间数量
+BATCH_CHECK_SIZE = 50
+# 开播但无法获取直播流(地区限制、加密等)的直播间之后跳过的检测次数
+UNPLAYABLE_SKIP = 5
+# {直播间号: 剩余跳过的检测次数}
+unplayable = {}
+
 
 @Plugin.download(regexp=r'(?:https?://)?(?:(?:www|m|live)\.)?bilibili\.com')
 class Bilibili(DownloadBase):
@@ -21,16 +30,7 @@ class Bilibili(DownloadBase):
     def check_stream(self, is_check=False):
 
         # 预读配置
-        params = {
-            'room_id': match1(self.url, r'/(\d+)'),
-            'protocol': '0,1',# 0: http_stream, 1: http_hls
-            'format': '0,1,2',# 0: flv, 1: ts, 2: fmp4
-            'codec': '0', # 0: avc, 1: hevc
-            'qn': config.get('bili_qn', '10000'),
-            'platform': 'html5', # 使用 html5 时默认屏蔽 p2p
-            'dolby': '5',
-            'panorama': '1'
-        }
+        params = play_params(match1(self.url, r'/(\d+)'))
         protocol = config.get('bili_protocol', 'stream')
         perf_cdn = config.get('bili_perfCDN')
         bili_cdn_fallback = config.get('bili_cdn_fallback', True)
@@ -58,10 +58,8 @@ class Bilibili(DownloadBase):
             if self.room_title is None:
                 self.room_title = room_info['data']['room_info']['title']
 
-            # 当 Cookie 存在，并且自定义APi使用Cookie开关关闭时，仅使用官方 Api
-            isallow = True if s.headers.get('cookie') is None else config.get('user', {}).get('customAPI_use_cookie', False)
             try:
-                play_info = get_play_info(s, isallow, official_api_host, params)
+                play_info = get_play_info(s, allow_custom_api(s), official_api_host, params)
             except:
                 logger.error("使用官方 Api 失败")
                 return False
@@ -129,6 +127,9 @@ class Bilibili(DownloadBase):
             if force_source:
                 stream_url['base_url'] = re.sub(r'_bluray(?=(/index)?\.m3u8)', "", stream_url['base_url'], 1)
         self.raw_stream_url = stream_url['host'] + stream_url['base_url'] + stream_url['extra']
+        # 其他CDN节点 录制停滞时直接切换
+        self.alternative_urls = [url_info['host'] + stream_url['base_url'] + url_info['extra']
+                                 for url_info in stream_info['url_info'] if url_info['host'] != stream_url['host']]
 
         # 强制替换ov05 302redirect之后的真实地址为指定的域名或ip达到自选ov05节点的目的
         if ov05_ip and "ov-gotcha05" in stream_url['host']:
@@ -148,6 +149,73 @@ class Bilibili(DownloadBase):
                 pass
         return True
 
+    @staticmethod
+    def batch_check(check_urls: List[str]) -> Generator[str, None, None]:
+        # getRoomBaseInfo 一次请求即可获取多个直播间的开播状态
+        # 这里只做廉价的状态检测 开播后下载时才会调用check_stream解析直播流
+        room_urls = {}
+        for url in check_urls:
+            room_id = match1(url, r'/(\d+)')
+            if not room_id:
+                logger.warning(f"{Bilibili.__name__}: {url}: 直播间地址错误")
+                continue
+            room_urls.setdefault(room_id, []).append(url)
+        room_ids = list(room_urls)
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/92.0.4515.159 Safari/537.36',
+            'Referer': 'https://live.bilibili.com',
+        }
+        if config.get('user', {}).get('bili_cookie') is not None:
+            headers['cookie'] = config.get('user', {}).get('bili_cookie')
+        with requests.Session() as s:
+            s.headers = headers
+            for i in range(0, len(room_ids), BATCH_CHECK_SIZE):
+                params = [('req_biz', 'web_room_componet')]
+                params += [('room_ids', room_id) for room_id in room_ids[i:i + BATCH_CHECK_SIZE]]
+                try:
+                    res = s.get('https://api.live.bilibili.com/xlive/web-room/v1/index/getRoomBaseInfo',
+                                params=params, timeout=5).json()
+                except:
+                    logger.warning(f"{Bilibili.__name__}: 批量获取直播间状态错误，本次跳过")
+                    continue
+                if res.get('code') != 0:
+                    logger.warning(f"{Bilibili.__name__}: 批量获取直播间状态错误 {res.get('message')}")
+                    continue
+                for room_info in (res['data'].get('by_room_ids') or {}).values():
+                    if room_info.get('live_status') != 1:
+                        # 下播后重新开播时不再跳过
+                        unplayable.pop(str(room_info.get('room_id')), None)
+                        continue
+                    # 配置中可能是短号 也可能是长号
+                    urls = [url for room_id in (str(room_info.get('room_id')), str(room_info.get('short_id')))
+                            for url in room_urls.pop(room_id, [])]
+                    if urls and Bilibili.playable(s, str(room_info.get('room_id'))):
+                        yield from urls
+
+    @staticmethod
+    def playable(s, room_id):
+        """
+        getRoomBaseInfo 只有开播状态，开播的直播间再确认能否获取直播流。
+        无法获取的直播间之后 UNPLAYABLE_SKIP 次检测直接跳过，避免每次都启动下载并占用线程池直到下播延迟结束
+        """
+        skip = unplayable.get(room_id, 0)
+        if skip > 0:
+            unplayable[room_id] = skip - 1
+            return False
+        try:
+            play_info = get_play_info(s, allow_custom_api(s), 'https://api.live.bilibili.com', play_params(room_id))
+        except Exception:
+            # 交给下载时的 check_stream 处理
+            logger.debug(f"{Bilibili.__name__}: {room_id}: 获取直播流信息失败")
+            return True
+        if play_info.get('code') == 0 and ((play_info.get('data') or {}).get('playurl_info') or {}).get('playurl'):
+            unplayable.pop(room_id, None)
+            return True
+        logger.warning(f"{Bilibili.__name__}: {room_id}: 已开播但无法获取直播流(可能遇到地区限制)，"
+                       f"之后 {UNPLAYABLE_SKIP} 次检测跳过")
+        unplayable[room_id] = UNPLAYABLE_SKIP
+        return False
+
     def danmaku_download_start(self, filename):
         if self.bilibili_danmaku:
             self.danmaku = DanmakuClient(self.url, filename + "." + self.suffix)
@@ -158,6 +226,24 @@ class Bilibili(DownloadBase):
             self.danmaku.stop()
 
 
+def play_params(room_id):
+    return {
+        'room_id': room_id,
+        'protocol': '0,1',# 0: http_stream, 1: http_hls
+        'format': '0,1,2',# 0: flv, 1: ts, 2: fmp4
+        'codec': '0', # 0: avc, 1: hevc
+        'qn': config.get('bili_qn', '10000'),
+        'platform': 'html5', # 使用 html5 时默认屏蔽 p2p
+        'dolby': '5',
+        'panorama': '1'
+    }
+
+
+def allow_custom_api(s):
+    # 当 Cookie 存在，并且自定义APi使用Cookie开关关闭时，仅使用官方 Api
+    return True if s.headers.get('cookie') is None else config.get('user', {}).get('customAPI_use_cookie', False)
+
+
 def get_play_info(s, isallow, official_api_host, params):
     if isallow:
         custom_api_host = \
@@ -81,18 +81,24 @@ class Huya(DownloadBase):
                         stream_selected = stream_item
                         break
 
-                url_query = parse_qs(stream_selected["sFlvAntiCode"])
                 uid = random.randint(1400000000000, 1499999999999)
                 ws_time = hex(int(time.time() + 21600))[2:]
                 seq_id = round(time.time() * 1000) + uid
-                ws_secret_prefix = base64.b64decode(unquote(url_query['fm'][0]).encode()).decode().split("_")[0]
-                ws_secret_hash = hashlib.md5(
-                    f'{seq_id}|{url_query["ctype"][0]}|{url_query["t"][0]}'.encode()).hexdigest()
-                ws_secret = hashlib.md5(
-                    f'{ws_secret_prefix}_{uid}_{stream_selected["sStreamName"]}_{ws_secret_hash}_{ws_time}'.encode()).hexdigest()
+
+                def flv_url(stream_item):
+                    url_query = parse_qs(stream_item["sFlvAntiCode"])
+                    ws_secret_prefix = base64.b64decode(unquote(url_query['fm'][0]).encode()).decode().split("_")[0]
+                    ws_secret_hash = hashlib.md5(
+                        f'{seq_id}|{url_query["ctype"][0]}|{url_query["t"][0]}'.encode()).hexdigest()
+                    ws_secret = hashlib.md5(
+                        f'{ws_secret_prefix}_{uid}_{stream_item["sStreamName"]}_{ws_secret_hash}_{ws_time}'.encode()).hexdigest()
+                    return f'{stream_item["sFlvUrl"]}/{stream_item["sStreamName"]}.{stream_item["sFlvUrlSuffix"]}?wsSecret={ws_secret}&wsTime={ws_time}&seqid={seq_id}&ctype={url_query["ctype"][0]}&ver=1&fs={url_query["fs"][0]}&t={url_query["t"][0]}&uid={uid}&ratio={record_ratio}'
 
                 self.room_title = live_info['sIntroduction']
-                self.raw_stream_url = f'{stream_selected["sFlvUrl"]}/{stream_selected["sStreamName"]}.{stream_selected["sFlvUrlSuffix"]}?wsSecret={ws_secret}&wsTime={ws_time}&seqid={seq_id}&ctype={url_query["ctype"][0]}&ver=1&fs={url_query["fs"][0]}&t={url_query["t"][0]}&uid={uid}&ratio={record_ratio}'
+                self.raw_stream_url = flv_url(stream_selected)
+                # 其他CDN的直播流 录制停滞时切换或同时录制备用文件
+                self.alternative_urls = [flv_url(stream_item) for stream_item in stream_items
+                                         if stream_item is not stream_selected]
                 return True
             except:
                 logger.warning(f"{Huya.__name__}: {self.url}: 解析错误")
@@ -127,6 +127,7 @@ class Youtube(DownloadBase):
     def download(self, filename):
         # ydl下载的文件在下载失败时不可控
         # 临时存储在其他地方
+        output_dir, filename = os.path.split(filename)
         download_dir = f'./cache/temp/youtube/{filename}'
         try:
             ydl_opts = {
@@ -158,7 +159,7 @@ class Youtube(DownloadBase):
                 ydl.download([self.download_url])
             # 下载成功的情况下移动到运行目录
             for file in os.listdir(download_dir):
-                shutil.move(f'{download_dir}/{file}', '.')
+                shutil.move(f'{download_dir}/{file}', output_dir or '.')
         except DownloadError as e:
             if 'Requested format is not available' in e.msg:
                 logger.error(f"{Youtube.__name__}: {self.url}: 无法获取到流，请检查vcodec,acodec,height,filesize设置")
@@ -16,34 +16,52 @@ def upload(data):
     :return:
     """
     try:
-        index = data['name']
-        context = {**config, **config['streamers'][index]}
-        platform = context.get("uploader", "biliup-rs")
-        cls = Plugin.upload_plugins.get(platform)
-        if cls is None:
-            return logger.error(f"No such uploader: {platform}")
-        streamer = data.get('streamer', index)
-        date = data.get("date", time.localtime())
-        title = data.get('title', index)
-        url = data.get('url')
-        live_cover_path = data.get('live_cover_path')
-        data["format_title"] = custom_fmtstr(context.get('title', f'%Y.%m.%d{index}'), date, title, streamer, url)
-        if context.get('description'):
-            context['description'] = custom_fmtstr(context.get('description'), date, title, streamer, url)
-        data['dolby'] = config.get('dolby', 0)
-        data['hires'] = config.get('hires', 0)
-        data['no_reprint'] = config.get('no_reprint', 0)
-        data['open_elec'] = config.get('open_elec', 0)
-        sig = inspect.signature(cls)
-        kwargs = {}
-        for k in sig.parameters:
-            v = context.get(k)
-            if v:
-                kwargs[k] = v
-        return cls(index, data, **kwargs).start()
+        uploader = create_uploader(data)
+        if uploader is not None:
+            return uploader.start()
     except:
         logger.exception("Uncaught exception:")
 
 
+def upload_segment(data, filename):
+    """录制过程中预先上传已完成的分段"""
+    try:
+        if data['name'] not in config['streamers']:
+            return
+        uploader = create_uploader(data)
+        if uploader is not None:
+            return uploader.start_segment(filename)
+    except:
+        logger.exception("Uncaught exception:")
+
+
+def create_uploader(data):
+    index = data['name']
+    context = {**config, **config['streamers'].get(index, data.get('streamer_config', {}))}
+    platform = context.get("uploader", "biliup-rs")
+    cls = Plugin.get_upload_plugin(platform)
+    if cls is None:
+        return logger.error(f"No such uploader: {platform}")
+    streamer = data.get('streamer', index)
+    date = data.get("date", time.localtime())
+    title = data.get('title', index)
+    url = data.get('url')
+    live_cover_path = data.get('live_cover_path')
+    data["format_title"] = custom_fmtstr(context.get('title', f'%Y.%m.%d{index}'), date, title, streamer, url)
+    if context.get('description'):
+        context['description'] = custom_fmtstr(context.get('description'), date, title, streamer, url)
+    data['dolby'] = config.get('dolby', 0)
+    data['hires'] = config.get('hires', 0)
+    data['no_reprint'] = config.get('no_reprint', 0)
+    data['open_elec'] = config.get('open_elec', 0)
+    sig = inspect.signature(cls)
+    kwargs = {}
+    for k in sig.parameters:
+        v = context.get(k)
+        if v:
+            kwargs[k] = v
+    return cls(index, data, **kwargs)
+
+
 def custom_fmtstr(string, date, title, streamer, url):
     return time.strftime(string.encode('unicode-escape').decode(), date).encode().decode("unicode-escape").format(title=title, streamer=streamer, url=url)
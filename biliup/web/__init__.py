@@ -1,9 +1,10 @@
+import asyncio
 import json
 
 from aiohttp import web
 from .aiohttp_basicauth_middleware import basic_auth_middleware
 import stream_gears
-import biliup.common.reload
+from biliup.common.metrics import metrics
 from biliup.config import config
 from biliup.plugins.bili_webup import BiliBili, Data
 
@@ -59,7 +60,7 @@ async def set_streamer_config(request):
             config.data['streamers'][i]={}
         for key,Value in j.items():
             config.data['streamers'][i][key]=Value
-    for i in config.data['streamers']:
+    for i in list(config.data['streamers']):
         if i not in post_data['streamers']:
             del config.data['streamers'][i]
 
@@ -68,10 +69,12 @@ async def set_streamer_config(request):
 
 async def save_config(reequest):
     config.save()
-    biliup.common.reload.global_reloader.triggered = True
+    from biliup.handler import reload_streamers
+    # 重新加载需要等待锁 不能阻塞事件循环
+    await asyncio.get_running_loop().run_in_executor(None, reload_streamers)
     import logging
     logger = logging.getLogger('biliup')
-    logger.info("配置保存，将在进程空闲时重启")
+    logger.info("配置已保存并生效")
     return web.json_response({"status": 200}, status=200)
 
 
@@ -151,6 +154,10 @@ async def service(args, event_manager):
     async def url_status(request):
         return web.json_response(event_manager.context['KernelFunc'].get_url_status())
 
+    async def metrics_handler(request):
+        return web.Response(text=metrics.expose(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
     app = web.Application()
     try:
         from importlib.resources import files
@@ -159,6 +166,7 @@ async def service(args, event_manager):
         from importlib_resources import files
     app.add_routes([web.get('/api/check_tag', tag_check)])
     app.add_routes([web.get('/url-status', url_status)])
+    app.add_routes([web.get('/metrics', metrics_handler)])
     app.add_routes([web.get('/api/basic', get_basic_config)])
     app.add_routes([web.post('/api/setbasic', set_basic_config)])
     app.add_routes([web.get('/api/getconfig', get_streamer_config)])
@@ -0,0 +1,52 @@
+"""生成测试用的 FLV 文件 每一帧的数据中记录了它在直播中的真实时间"""
+import io
+
+from biliup.common.flv import AUDIO, SCRIPT, VIDEO, Tag, read_header, read_tags
+
+FLV_HEADER = b'FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00'
+
+
+def media_tags(start, end, keyframe_interval=1000):
+    """[start, end) 毫秒内的音视频帧 视频每40毫秒一帧，音频每23毫秒一帧"""
+    tags = []
+    for t in range((start + 39) // 40 * 40, end, 40):
+        frame_type = 0x17 if t % keyframe_interval == 0 else 0x27
+        tags.append(Tag(VIDEO, t, bytes((frame_type, 1)) + b'v%d' % t))
+    for t in range((start + 22) // 23 * 23, end, 23):
+        tags.append(Tag(AUDIO, t, b'\xaf\x01a%d' % t))
+    return sorted(tags, key=lambda tag: tag.timestamp)
+
+
+def header_tags(name=b''):
+    return [Tag(SCRIPT, 0, b'onMetaData' + name), Tag(VIDEO, 0, b'\x17\x00avc'), Tag(AUDIO, 0, b'\xaf\x00aac')]
+
+
+def flv_bytes(tags, base=0, name=b''):
+    """base 为时间戳的起点 模拟每份录制的时间戳各自从0开始"""
+    f = io.BytesIO()
+    f.write(FLV_HEADER)
+    for tag in header_tags(name):
+        tag.write(f)
+    for tag in tags:
+        tag.write(f, tag.timestamp - base)
+    return f.getvalue()
+
+
+def write_flv(path, tags, base=0, name=b''):
+    with open(path, 'wb') as f:
+        f.write(flv_bytes(tags, base, name))
+    return str(path)
+
+
+def read_flv(path):
+    with open(path, 'rb') as f:
+        read_header(f)
+        return list(read_tags(f))
+
+
+def real_time(tag):
+    return int(tag.body[3:])
+
+
+def frames(tags, type_=VIDEO):
+    return [tag for tag in tags if tag.type == type_ and not tag.is_header]
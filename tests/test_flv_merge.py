@@ -0,0 +1,115 @@
+import pytest
+
+from biliup.common import flv
+from biliup.common.flv import AUDIO, VIDEO
+from flv_helpers import frames, media_tags, read_flv, real_time, write_flv
+
+LIVE = media_tags(0, 20000)
+
+
+def between(*ranges):
+    return [tag for tag in LIVE if any(start <= tag.timestamp < end for start, end in ranges)]
+
+
+def merge(tmp_path, primary, backup, primary_base=0, backup_base=0):
+    filled = flv.merge(write_flv(tmp_path / 'primary.flv', primary, primary_base),
+                       write_flv(tmp_path / 'backup.flv', backup, backup_base, name=b'backup'),
+                       str(tmp_path / 'merged.flv'))
+    return filled, read_flv(tmp_path / 'merged.flv')
+
+
+def assert_aligned(tags, expected):
+    """每种帧的真实时间与预期一致，时间戳与真实时间之差恒定且严格递增"""
+    for type_ in (VIDEO, AUDIO):
+        merged = frames(tags, type_)
+        assert [real_time(tag) for tag in merged] == [real_time(tag) for tag in frames(expected, type_)]
+        assert len({tag.timestamp - real_time(tag) for tag in merged}) == 1
+        timestamps = [tag.timestamp for tag in merged]
+        assert timestamps == sorted(set(timestamps))
+        assert timestamps[0] >= 0
+
+
+def test_gap_in_primary(tmp_path):
+    filled, tags = merge(tmp_path, between((0, 5000), (8040, 20000)), LIVE)
+    assert_aligned(tags, LIVE)
+    # primary 恢复时不是关键帧 继续使用 backup 直到 primary 的下一个关键帧
+    assert filled == pytest.approx(4000, abs=100)
+
+
+def test_primary_starts_late_and_ends_early(tmp_path):
+    # 两份录制的时间戳各自从0开始
+    filled, tags = merge(tmp_path, between((3000, 15000)), between((500, 20000)),
+                         primary_base=3000, backup_base=500)
+    assert_aligned(tags, between((500, 20000)))
+    assert filled == pytest.approx(2500 + 5000, abs=100)
+
+
+def test_backup_starts_late(tmp_path):
+    # primary 不从关键帧开始 backup 晚开始但没有超过 max_gap
+    filled, tags = merge(tmp_path, between((300, 20000)), between((600, 20000)),
+                         primary_base=300, backup_base=600)
+    assert_aligned(tags, between((300, 20000)))
+    assert filled == 0
+
+
+def test_gaps_in_both_copies(tmp_path):
+    primary = between((0, 5000), (8000, 20000))
+    backup = between((0, 12000), (16000, 20000))
+    filled, tags = merge(tmp_path, primary, backup)
+    assert_aligned(tags, LIVE)
+    # 两份录制同时缺少的部分无法补上 也不会重复写入
+    filled, tags = merge(tmp_path, between((0, 5000), (8000, 20000)), between((0, 6000), (7000, 20000)))
+    assert_aligned(tags, between((0, 6000), (7000, 20000)))
+
+
+def test_identical_copies(tmp_path):
+    filled, tags = merge(tmp_path, LIVE, LIVE)
+    assert filled == 0
+    assert_aligned(tags, LIVE)
+    assert len(tags) == len(LIVE) + 3
+    # onMetaData 只取自主录制
+    assert [tag.body for tag in tags if tag.type == flv.SCRIPT] == [b'onMetaData']
+
+
+def test_headers_written_once(tmp_path):
+    _, tags = merge(tmp_path, between((0, 5000)), LIVE)
+    assert [tag.type for tag in tags[:3]] == [flv.SCRIPT, VIDEO, AUDIO]
+    assert sum(tag.is_header for tag in tags) == 3
+
+
+def test_unaligned_copies(tmp_path):
+    output = tmp_path / 'merged.flv'
+    # 两份录制没有相同的关键帧
+    filled = flv.merge(write_flv(tmp_path / 'primary.flv', between((0, 5000))),
+                       write_flv(tmp_path / 'backup.flv', between((5040, 10000))), str(output))
+    assert filled is None
+    assert not output.exists()
+
+
+def test_missing_primary(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        flv.merge(str(tmp_path / 'primary.flv'), write_flv(tmp_path / 'backup.flv', LIVE),
+                  str(tmp_path / 'merged.flv'))
+
+
+@pytest.fixture
+def downloader():
+    for module in ('aiohttp', 'requests', 'stream_gears'):
+        pytest.importorskip(module)
+    from biliup.engine.download import DownloadBase
+    return DownloadBase('streamer', 'https://example.com/live', suffix='flv')
+
+
+def test_merge_backup_fills_primary(tmp_path, downloader):
+    part = write_flv(tmp_path / 'live.flv.part', between((0, 5000)))
+    backup = write_flv(tmp_path / 'live.flv.backup', LIVE)
+    downloader.merge_backup(part, backup)
+    assert_aligned(read_flv(part), LIVE)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['live.flv.part']
+
+
+def test_merge_backup_without_primary(tmp_path, downloader):
+    part = str(tmp_path / 'live.flv.part')
+    downloader.merge_backup(part, write_flv(tmp_path / 'live.flv.backup', LIVE))
+    assert_aligned(read_flv(part), LIVE)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['live.flv.part']
@@ -0,0 +1,133 @@
+import os
+import random
+
+import pytest
+
+from biliup.common.flv import AUDIO, SCRIPT, VIDEO, FlvParser, FlvWriter, Tag
+from flv_helpers import FLV_HEADER, flv_bytes, frames, media_tags, read_flv, real_time
+
+LIVE = media_tags(0, 20000)
+
+
+def parse(data, chunk=None):
+    parser = FlvParser()
+    tags = []
+    for i in range(0, len(data), chunk or len(data)):
+        tags += parser.feed(data[i:i + (chunk or len(data))])
+    return parser, tags
+
+
+def record(tmp_path, data, **kwargs):
+    names = []
+
+    def new_name():
+        names.append(str(tmp_path / f'{len(names)}.flv'))
+        return names[-1]
+
+    writer = FlvWriter(new_name, **kwargs)
+    parser = FlvParser()
+    rng = random.Random(0)
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(1, 4096)
+        for tag in parser.feed(data[pos:pos + size]):
+            if writer.header is None:
+                writer.write_header(parser.header)
+            writer.write(tag)
+        pos += size
+    writer.close()
+    return [read_flv(name) for name in names]
+
+
+def test_parser_chunk_boundaries():
+    data = flv_bytes(LIVE)
+    parser, whole = parse(data)
+    assert parser.header == FLV_HEADER
+    for chunk in (1, 7, 4096):
+        _, tags = parse(data, chunk)
+        assert [(tag.type, tag.timestamp, tag.body) for tag in tags] == \
+               [(tag.type, tag.timestamp, tag.body) for tag in whole]
+    assert len(whole) == len(LIVE) + 3
+
+
+def test_parser_data_offset():
+    # DataOffset 大于9时跳过文件头中多余的字节
+    data = b'FLV\x01\x05\x00\x00\x00\x0cxyz\x00\x00\x00\x00' + flv_bytes(LIVE)[13:]
+    parser, tags = parse(data, 5)
+    assert parser.header == FLV_HEADER
+    assert len(tags) == len(LIVE) + 3
+
+
+def test_parser_truncated_tag():
+    data = flv_bytes(LIVE)
+    parser, tags = parse(data[:-20])
+    # 最后一个不完整的 tag 留在缓冲区中
+    assert len(tags) == len(LIVE) + 2
+    assert [tag.body for tag in parser.feed(data[-20:])] == [LIVE[-1].body]
+
+
+def test_parser_corrupt():
+    with pytest.raises(ValueError):
+        FlvParser().feed(b'<html>' + b'\x00' * 20)
+    data = flv_bytes(LIVE[:10])
+    parser = FlvParser()
+    # 损坏之前的 tag 仍然返回，之后的调用抛出异常
+    assert len(parser.feed(data + b'\x42' * 20)) == 13
+    with pytest.raises(ValueError):
+        parser.feed(b'')
+
+
+def test_segments_start_on_keyframe(tmp_path):
+    segments = record(tmp_path, flv_bytes(LIVE), segment_time=5)
+    assert len(segments) == 4
+    for i, tags in enumerate(segments):
+        video = frames(tags)
+        assert video[0].keyframe
+        assert video[0].timestamp == 0
+        assert real_time(video[0]) == i * 5000
+        assert all(tag.timestamp >= 0 for tag in tags)
+    assert sum(len(frames(tags)) for tags in segments) == len(frames(LIVE))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.part')]
+
+
+def test_segments_by_file_size(tmp_path):
+    size = len(flv_bytes(LIVE))
+    segments = record(tmp_path, flv_bytes(LIVE), file_size=size // 3)
+    assert len(segments) in (3, 4)
+    assert all(frames(tags)[0].keyframe for tags in segments)
+
+
+def test_headers_in_every_segment(tmp_path):
+    for tags in record(tmp_path, flv_bytes(LIVE), segment_time=5):
+        assert [tag.type for tag in tags[:3]] == [SCRIPT, VIDEO, AUDIO]
+        assert all(tag.is_header for tag in tags[:3])
+        assert sum(tag.is_header for tag in tags) == 3
+
+
+def test_drop_frames_before_first_keyframe(tmp_path):
+    segments = record(tmp_path, flv_bytes(media_tags(500, 3000)))
+    video = frames(segments[0])
+    assert real_time(video[0]) == 1000
+    assert min(tag.timestamp for tag in segments[0] if not tag.is_header) >= 0
+
+
+@pytest.mark.parametrize('jump', [-15000, 900000])
+def test_timestamp_discontinuity(tmp_path, jump):
+    # 直播流的时间戳在 10 秒处回退或跳变
+    tags = [Tag(tag.type, tag.timestamp + jump if tag.timestamp >= 10000 else tag.timestamp, tag.body)
+            for tag in LIVE]
+    segments = record(tmp_path, flv_bytes(tags))
+    assert len(segments) == 1
+    for type_, interval in ((VIDEO, 40), (AUDIO, 23)):
+        merged = frames(segments[0], type_)
+        assert len(merged) == len(frames(LIVE, type_))
+        assert all(b.timestamp - a.timestamp == interval for a, b in zip(merged, merged[1:]))
+
+
+def test_audio_only_stream(tmp_path):
+    audio = [tag for tag in LIVE if tag.type == AUDIO]
+    data = bytearray(flv_bytes(audio))
+    data[4] = 0x04
+    segments = record(tmp_path, bytes(data), segment_time=5)
+    assert len(segments) == 4
+    assert all(frames(tags, AUDIO)[0].timestamp == 0 for tags in segments)
@@ -0,0 +1,87 @@
+import contextlib
+import os
+
+import pytest
+
+from biliup.common.flv import FlvParser
+from flv_helpers import flv_bytes, media_tags, read_flv
+
+
+class FakeDanmaku:
+    def __init__(self, filename):
+        self.xml = os.path.splitext(filename)[0] + '.xml'
+        self.stopped = False
+
+    def start(self):
+        open(self.xml, 'w').close()
+
+    def stop(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def downloader(tmp_path, monkeypatch):
+    for module in ('aiohttp', 'requests', 'stream_gears'):
+        pytest.importorskip(module)
+    from biliup.config import config
+    from biliup.engine import download, httpflv
+
+    added = []
+
+    async def record(url, headers, writer, stall_timeout=20):
+        # 8秒的直播流分为两段 两个分段的文件名相同
+        parser = FlvParser()
+        try:
+            for tag in parser.feed(flv_bytes(media_tags(0, 8000))):
+                if writer.header is None:
+                    writer.write_header(parser.header)
+                writer.write(tag)
+        finally:
+            writer.close()
+        return True
+
+    class Catalog:
+        def add(self, streamer, name):
+            added.append(name)
+
+    class Plugin(download.DownloadBase):
+        danmakus = []
+
+        @property
+        def file_name(self):
+            return 'live'
+
+        def segment_closed(self, filename):
+            self.segments.append(filename)
+
+        def danmaku_download_start(self, filename):
+            self.danmaku = FakeDanmaku(filename + '.' + self.suffix)
+            self.danmakus.append(self.danmaku)
+            self.danmaku.start()
+
+    monkeypatch.setattr(httpflv, 'record', record)
+    monkeypatch.setattr(download, 'catalog', Catalog())
+    monkeypatch.setattr(download, 'output_dir', lambda *args, **kwargs: str(tmp_path))
+    monkeypatch.setattr(download.placement, 'place', lambda: contextlib.nullcontext(str(tmp_path)))
+    monkeypatch.setitem(config, 'downloader', 'native')
+    monkeypatch.setitem(config, 'segment_time', '00:00:05')
+    plugin = Plugin('streamer', 'https://example.com/live', suffix='flv')
+    plugin.raw_stream_url = 'https://example.com/live/stream.flv'
+    plugin.added = added
+    plugin.segments = []
+    return plugin
+
+
+def test_native_segments(tmp_path, downloader):
+    assert downloader.download(None)
+    videos = sorted(path.name for path in tmp_path.glob('*.flv'))
+    assert videos == ['live.flv', 'live_1.flv']
+    assert all(read_flv(tmp_path / name) for name in videos)
+    # 每个分段都有同名的弹幕 上个分段的弹幕在下个分段开始时停止
+    assert sorted(path.name for path in tmp_path.glob('*.xml')) == ['live.xml', 'live_1.xml']
+    assert [danmaku.xml for danmaku in downloader.danmakus] == [
+        str(tmp_path / 'live.xml'), str(tmp_path / 'live_1.xml')]
+    assert downloader.danmakus[0].stopped
+    # 每个分段写完时发送一次分段事件
+    assert downloader.segments == [str(tmp_path / name) for name in videos]
+    assert sorted(downloader.added) == sorted(str(tmp_path / name) for name in videos + ['live.xml', 'live_1.xml'])